@@ -0,0 +1,112 @@
+# LFReader
+# Copyright (C) 2022-2025  DCsunset
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Local stand-in of feed servers serving a synthetic corpus.
+
+Feeds are available at /feeds/{i}.xml and images at /images/{i}/{j}/{k}.png
+(image k of entry j in feed i). Content is generated deterministically
+so that repeated fetches return the same feeds.
+"""
+
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from aiohttp import web
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore magna aliqua".split()
+
+class Corpus:
+  def __init__(self, feeds: int, entries: int, images: int, image_size: int, base_url: str):
+    self.feeds = feeds
+    self.entries = entries
+    self.images = images
+    self.image_size = image_size
+    self.base_url = base_url
+
+  def feed_url(self, i: int):
+    return f"{self.base_url}/feeds/{i}.xml"
+
+  def text(self, rng: random.Random, words: int):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+  def feed_xml(self, i: int) -> str:
+    rng = random.Random(i)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    items = []
+    for j in range(self.entries):
+      images = "".join(
+        f'<img src="/images/{i}/{j}/{k}.png" alt="image {k}">'
+        for k in range(self.images)
+      )
+      published = format_datetime(start + timedelta(hours=j * 6 + i % 6))
+      items.append(f"""
+        <item>
+          <title>{self.text(rng, 6)}</title>
+          <link>{self.base_url}/posts/{i}/{j}</link>
+          <guid>{self.base_url}/posts/{i}/{j}</guid>
+          <author>author{i}@example.com</author>
+          <pubDate>{published}</pubDate>
+          <description><![CDATA[<p>{self.text(rng, 40)}</p>{images}<p>{self.text(rng, 80)}</p>]]></description>
+        </item>""")
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+      <rss version="2.0">
+        <channel>
+          <title>Feed {i}</title>
+          <link>{self.base_url}/posts/{i}</link>
+          <description>{self.text(rng, 12)}</description>
+          {"".join(items)}
+        </channel>
+      </rss>"""
+
+  def image(self, path: str) -> bytes:
+    # distinct content for each image
+    seed = path.encode()
+    return (seed * (self.image_size // len(seed) + 1))[:self.image_size]
+
+
+def create_app(corpus: Corpus, latency: float, failure_rate: float, seed: int = 0):
+  rng = random.Random(seed)
+
+  async def delay_or_fail():
+    if latency > 0:
+      await asyncio.sleep(latency)
+    if rng.random() < failure_rate:
+      raise web.HTTPInternalServerError(text="injected failure")
+
+  async def feed(req: web.Request):
+    await delay_or_fail()
+    i = int(req.match_info["feed"])
+    if i >= corpus.feeds:
+      raise web.HTTPNotFound()
+    return web.Response(text=corpus.feed_xml(i), content_type="application/rss+xml")
+
+  async def image(req: web.Request):
+    await delay_or_fail()
+    return web.Response(body=corpus.image(req.path), content_type="image/png")
+
+  app = web.Application()
+  app.router.add_get("/feeds/{feed}.xml", feed)
+  app.router.add_get("/images/{feed}/{entry}/{image}.png", image)
+  return app
+
+
+def serve(corpus: Corpus, host: str, port: int, latency: float, failure_rate: float):
+  """
+  Run server until the process is terminated (used as target of a process)
+  """
+  web.run_app(create_app(corpus, latency, failure_rate), host=host, port=port, print=None)
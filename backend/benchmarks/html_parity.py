@@ -0,0 +1,100 @@
+# LFReader
+# Copyright (C) 2022-2025  DCsunset
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Check that html engines archive the same resources.
+
+Run in the backend directory:
+  python -m benchmarks.html_parity
+
+Resources found by the tokenizer are compared with the ones found by BeautifulSoup
+(html.parser, and lxml if installed) for sample html and archive options.
+Exits with non-zero status if any engine differs.
+"""
+
+import asyncio
+import importlib.util
+import re
+import sys
+
+from lfreader_server.archive import Archiver
+from lfreader_server.config import ArchiverConfig, ArchiveOption
+
+SAMPLES = [
+  '<p>text</p><img src="a.png"><img alt="x">',
+  '<a class="dl big" href="a.zip">a</a><a class="big" href="b.zip">b</a>',
+  '<a rel="nofollow enclosure" href="c.mp3">c</a><link rel="stylesheet icon" href="d.ico">',
+  '<div class=" dl  " data-src="e.png"></div><div class="dl2" data-src="f.png"></div>',
+  '<IMG SRC="g.png"/><video poster="h.jpg"><source src="i.mp4"></video>',
+  '<img src="j.png" class="lazy thumb" data-src="k.png"><iframe sandbox="allow-scripts" src="l.html"></iframe>',
+  '<img src=""><img src="m.png?a=1&amp;b=2"><!-- <img src="n.png"> --><script>"<img src=o.png>"</script>',
+]
+
+OPTIONS = {
+  "default": [ArchiveOption(attr="src")],
+  "tag regex": [ArchiveOption(attr="src", tag_filter=re.compile("^(img|source)$"))],
+  "class list": [ArchiveOption(attr="href", attr_filters={"class": ["dl"]})],
+  "class regex": [ArchiveOption(attr="data-src", attr_filters={"class": re.compile("^dl$")})],
+  "whole class": [ArchiveOption(attr="href", attr_filters={"class": ["dl big"]})],
+  "rel": [ArchiveOption(attr="href", attr_filters={"rel": ["enclosure", "icon"]})],
+  "sandbox": [ArchiveOption(attr="src", tag_filter=["iframe"], attr_filters={"sandbox": ["allow-scripts"]})],
+  "multiple": [ArchiveOption(attr="src"), ArchiveOption(attr="data-src", attr_filters={"class": ["lazy"]})],
+}
+
+class RecordingArchiver(Archiver):
+  """
+  Record resources to archive instead of downloading them
+  """
+  def __init__(self, config: ArchiverConfig):
+    super().__init__(None, config, None)
+    self.archived = []
+
+  async def archive_resource(self, session, feed_url, entry_id, src, base_url, user_data):
+    self.archived.append(src)
+    return f"/archives/{src}"
+
+async def archived_resources(engine: str, options: list[ArchiveOption], html: str):
+  archiver = RecordingArchiver(ArchiverConfig(
+    file_index=False,
+    html_engine=engine,
+    # copy options as BeautifulSoup engines add attr to filters
+    archive_options=[opt.model_copy(deep=True) for opt in options]
+  ))
+  await archiver.archive_html(None, "", "", html, None, {})
+  return sorted(archiver.archived)
+
+async def check():
+  engines = ["html.parser"]
+  if importlib.util.find_spec("lxml"):
+    engines.append("lxml")
+  mismatches = 0
+  for name, options in OPTIONS.items():
+    for html in SAMPLES:
+      expected = await archived_resources("tokenizer", options, html)
+      for engine in engines:
+        actual = await archived_resources(engine, options, html)
+        if actual != expected:
+          mismatches += 1
+          print(f"[{name}] {engine} archived {actual} but tokenizer archived {expected}: {html}")
+  print(f"Checked {len(OPTIONS) * len(SAMPLES)} cases against {', '.join(engines)}: {mismatches} mismatches")
+  return mismatches == 0
+
+def main():
+  sys.exit(0 if asyncio.run(check()) else 1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,279 @@
+# LFReader
+# Copyright (C) 2022-2025  DCsunset
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+End-to-end benchmarks of fetching, archiving and querying.
+
+Run in the backend directory:
+  python -m benchmarks.run --feeds 1000 --entries 10 --images 1 --scales 10000,100000
+
+Results are printed and can be saved as JSON (--output) to compare across commits.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from lfreader_server.config import Config
+from lfreader_server.models import FeedInfo
+from lfreader_server.storage import Storage, pack_data, encode_cursor
+from .feed_server import Corpus, serve
+
+# columns loaded by frontend for entry list
+LIST_COLUMNS = [
+  "feed_url", "id", "link", "author", "title", "categories", "enclosures",
+  "published_at", "updated_at", "server_data", "user_data"
+]
+
+def percentile(values: list[float], p: float):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def measure(func, repeat: int):
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - start)
+  return {
+    "p50_ms": round(percentile(times, 50) * 1000, 3),
+    "p99_ms": round(percentile(times, 99) * 1000, 3),
+    "mean_ms": round(statistics.fmean(times) * 1000, 3),
+  }
+
+def dir_size(path: str):
+  if not os.path.isdir(path):
+    return 0
+  with os.scandir(path) as it:
+    return sum(e.stat().st_size for e in it if e.is_file())
+
+def db_size(db_file: str):
+  return sum(os.path.getsize(f) for f in (db_file, f"{db_file}-wal") if os.path.exists(f))
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except Exception:
+    return None
+
+def wait_for_port(host: str, port: int, timeout: float = 10):
+  deadline = time.monotonic() + timeout
+  while True:
+    try:
+      with socket.create_connection((host, port), timeout=1):
+        return
+    except OSError:
+      if time.monotonic() > deadline:
+        raise
+      time.sleep(0.1)
+
+def create_config(args, data_dir: str):
+  config = Config(db_file=f"{data_dir}/db.sqlite", log_level="warning")
+  config.archiver.base_dir = f"{data_dir}/archives"
+  config.archiver.retry_attempts = args.retry_attempts
+  config.archiver.retry_delay = 1
+  config.compression_threshold = args.compression_threshold
+  os.makedirs(config.archiver.base_dir, exist_ok=True)
+  return config
+
+
+async def bench_fetch_archive(args, corpus: Corpus, data_dir: str):
+  config = create_config(args, data_dir)
+  storage = Storage(config)
+  feeds = [FeedInfo(url=corpus.feed_url(i), user_data={}) for i in range(corpus.feeds)]
+  results = {}
+  try:
+    start = time.perf_counter()
+    await storage.fetch_feeds(feeds, False, False, True)
+    duration = time.perf_counter() - start
+    entries = storage.db.execute("SELECT COUNT(*) AS 'n' FROM entries WHERE id != ''").fetchone()["n"]
+    results["fetch"] = {
+      "seconds": round(duration, 3),
+      "feeds_per_second": round(corpus.feeds / duration, 1),
+      "entries": entries,
+      "entries_per_second": round(entries / duration, 1),
+    }
+
+    # fetch again to measure refresh of unchanged feeds
+    start = time.perf_counter()
+    await storage.fetch_feeds(feeds, False, False, True)
+    duration = time.perf_counter() - start
+    results["refetch"] = {
+      "seconds": round(duration, 3),
+      "feeds_per_second": round(corpus.feeds / duration, 1),
+    }
+
+    if corpus.images > 0:
+      start = time.perf_counter()
+      await storage.archive_feeds()
+      duration = time.perf_counter() - start
+      resources = storage.db.execute("SELECT COUNT(*) AS 'n' FROM resources").fetchone()["n"]
+      archived_bytes = dir_size(config.archiver.base_dir)
+      results["archive"] = {
+        "seconds": round(duration, 3),
+        "resources": resources,
+        "resources_per_second": round(resources / duration, 1),
+        "mb_per_second": round(archived_bytes / duration / 1e6, 2),
+      }
+    results["db_bytes"] = db_size(config.db_file)
+  finally:
+    await storage.close()
+  return results
+
+
+def synthetic_rows(start: int, count: int, feeds: int, compression_threshold: int):
+  words = "lorem ipsum dolor sit amet consectetur adipiscing elit".split()
+  for n in range(start, start + count):
+    feed_url = f"http://bench.local/feeds/{n % feeds}.xml"
+    text = " ".join(words[(n + k) % len(words)] for k in range(60))
+    summary = {"type": "text/html", "value": f"<p>{text}</p>"}
+    published = f"{2000 + n % 25}-{1 + n % 12:02}-{1 + n % 28:02}T{n % 24:02}:00:00+00:00"
+    yield (
+      feed_url,
+      f"entry-{n}",
+      f"http://bench.local/posts/{n}",
+      f"author{n % 100}",
+      f"Entry {n} {words[n % len(words)]}",
+      None,
+      pack_data(summary, compression_threshold),
+      pack_data([summary], compression_threshold),
+      None,
+      published,
+      published,
+      pack_data({"added_at": published}),
+      None
+    )
+
+def bench_queries(args, data_dir: str):
+  config = create_config(args, data_dir)
+  storage = Storage(config)
+  results = {}
+  try:
+    storage.db.executemany(
+      "INSERT INTO feeds(url, title) VALUES (?, ?)",
+      [(f"http://bench.local/feeds/{i}.xml", f"Feed {i}") for i in range(args.query_feeds)]
+    )
+    storage.db.executemany(
+      "INSERT INTO entries(feed_url, id) VALUES (?, '')",
+      [(f"http://bench.local/feeds/{i}.xml",) for i in range(args.query_feeds)]
+    )
+    storage.db.commit()
+
+    count = 0
+    for scale in sorted(args.scales):
+      prev_count = count
+      start = time.perf_counter()
+      while count < scale:
+        batch = min(args.batch_size, scale - count)
+        seq = storage.latest_change()
+        storage.save_entries(seq, list(synthetic_rows(count, batch, args.query_feeds, args.compression_threshold)))
+        count += batch
+      insert_duration = time.perf_counter() - start
+      logging.warning(f"Populated {scale} entries")
+
+      # cursor in the middle of all entries
+      mid = storage.get_entries(None, None, scale // 2, 1, ["feed_url", "id", "published_at", "updated_at"])[0]
+      mid_cursor = encode_cursor(mid["published_at"] or mid["updated_at"] or "", mid["feed_url"], mid["id"])
+      latest = storage.latest_change()
+      one_feed = ["http://bench.local/feeds/0.xml"]
+
+      queries = {
+        "first_page": lambda: storage.get_entries_page(None, None, "", 100, LIST_COLUMNS),
+        "middle_page_cursor": lambda: storage.get_entries_page(None, None, mid_cursor, 100, LIST_COLUMNS),
+        "middle_page_offset": lambda: storage.get_entries(None, None, scale // 2, 100, LIST_COLUMNS),
+        "feed_first_page": lambda: storage.get_entries_page(one_feed, None, "", 100, LIST_COLUMNS),
+        "search": lambda: storage.search_entries("lorem ipsum", None, -1, 20, ["feed_url", "id", "title"]),
+        "changes": lambda: storage.get_changes(latest - 100, LIST_COLUMNS),
+      }
+      results[scale] = {
+        "insert_rows_per_second": round((count - prev_count) / max(insert_duration, 1e-6), 1),
+        "db_bytes": db_size(config.db_file),
+        **{name: measure(func, args.repeat) for name, func in queries.items()},
+        # full entry list as loaded by frontend
+        "list_all": measure(lambda: "".join(storage.get_entries_json(None, None, -1, -1, LIST_COLUMNS)), args.repeat_all),
+      }
+  finally:
+    asyncio.run(storage.close())
+  return results
+
+
+def print_results(results: dict, indent: int = 0):
+  for key, value in results.items():
+    if isinstance(value, dict):
+      print(f"{' ' * indent}{key}:")
+      print_results(value, indent + 2)
+    else:
+      print(f"{' ' * indent}{key}: {value}")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="LFReader backend benchmarks")
+  parser.add_argument("--feeds", type=int, default=1000, help="number of feeds to fetch")
+  parser.add_argument("--entries", type=int, default=10, help="entries per feed")
+  parser.add_argument("--images", type=int, default=1, help="images per entry (0 to skip archiving)")
+  parser.add_argument("--image-size", type=int, default=20000, help="size of each image in bytes")
+  parser.add_argument("--latency", type=float, default=0.0, help="latency of feed server in seconds")
+  parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of failed requests")
+  parser.add_argument("--retry-attempts", type=int, default=2, help="retry attempts of resource downloads")
+  parser.add_argument("--port", type=int, default=8901, help="port of feed server")
+  parser.add_argument("--scales", type=lambda s: [int(v) for v in s.split(",")], default=[10000, 100000], help="comma-separated numbers of entries for query benchmarks (e.g. 10000,100000,1000000)")
+  parser.add_argument("--query-feeds", type=int, default=100, help="number of feeds in query benchmarks")
+  parser.add_argument("--batch-size", type=int, default=5000, help="rows per batch when populating db")
+  parser.add_argument("--repeat", type=int, default=100, help="repetitions of each query")
+  parser.add_argument("--repeat-all", type=int, default=5, help="repetitions of loading all entries")
+  parser.add_argument("--compression-threshold", type=int, default=0, help="compression_threshold in config")
+  parser.add_argument("--skip-fetch", action="store_true", help="skip fetch and archive benchmarks")
+  parser.add_argument("--skip-query", action="store_true", help="skip query benchmarks")
+  parser.add_argument("-o", "--output", help="save results as JSON")
+  args = parser.parse_args()
+
+  results = {"commit": git_commit(), "args": vars(args)}
+  with tempfile.TemporaryDirectory() as data_dir:
+    if not args.skip_fetch:
+      host = "127.0.0.1"
+      corpus = Corpus(args.feeds, args.entries, args.images, args.image_size, f"http://{host}:{args.port}")
+      # run server in another process to avoid competing for the event loop
+      server = multiprocessing.get_context("spawn").Process(
+        target=serve,
+        args=(corpus, host, args.port, args.latency, args.failure_rate),
+        daemon=True
+      )
+      server.start()
+      try:
+        wait_for_port(host, args.port)
+        results["fetch_archive"] = asyncio.run(bench_fetch_archive(args, corpus, f"{data_dir}/fetch"))
+      finally:
+        server.terminate()
+
+    if not args.skip_query:
+      results["query"] = bench_queries(args, f"{data_dir}/query")
+
+  print_results(results)
+  if args.output:
+    Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+  main()
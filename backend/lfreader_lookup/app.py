@@ -51,13 +51,21 @@ def main():
     digest = blake2s(url.encode()).hexdigest()
     return  f"{digest}{ext}"
 
+  # content-addressed filenames (table doesn't exist in old databases)
+  has_files = db.execute(
+    "SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'resource_files')"
+  ).fetchone()[0]
+  files_col = "resource_files.filename" if has_files else "NULL"
+  files_join = "LEFT JOIN resource_files ON resources.url = resource_files.url" if has_files else ""
+
   cnt = 1
-  for r in db.execute('''
-    SELECT resources.feed_url, feeds.title AS feed_title, entry_id, entries.title AS entry_title, resources.url FROM resources
+  for r in db.execute(f'''
+    SELECT resources.feed_url, feeds.title AS feed_title, entry_id, entries.title AS entry_title, resources.url, {files_col} AS filename FROM resources
       INNER JOIN feeds ON resources.feed_url = feeds.url
       LEFT JOIN entries ON resources.entry_id = entries.id
+      {files_join}
   '''):
-    if filename_from_url(r["url"]) == filename:
+    if (r["filename"] or filename_from_url(r["url"])) == filename:
       print(f"Ref {cnt}:")
       print(f"  URL: {r['url']}")
       print(f"  Feed: {r['feed_title']} ({r['feed_url']})")
@@ -0,0 +1,113 @@
+# LFReader
+# Copyright (C) 2022-2025  DCsunset
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import logging
+import json
+import os
+import sys
+from pydantic import ValidationError
+
+from .storage import Storage
+from .config import Config
+
+
+def rebuild_search_index(storage: Storage, args):
+  storage.rebuild_search_index()
+
+
+def dedup_archives(storage: Storage, args):
+  count, reclaimed = storage.archiver.dedup_files(args.dry_run)
+  if not args.dry_run:
+    storage.archiver.touch_index_stamp()
+  action = "Found" if args.dry_run else "Deduplicated"
+  print(f"{action} {count} duplicate files ({reclaimed} bytes)")
+
+
+def gc_archives(storage: Storage, args):
+  count, size = asyncio.run(storage.archiver.collect_garbage(args.dry_run))
+  if not args.dry_run:
+    storage.archiver.touch_index_stamp()
+  action = "Found" if args.dry_run else "Deleted"
+  print(f"{action} {count} orphan files ({size} bytes)")
+
+
+def prune_changes(storage: Storage, args):
+  count = storage.prune_changes(args.before_seq)
+  print(f"Pruned {count} tombstones of deleted feeds and entries")
+
+
+def compress_entries(storage: Storage, args):
+  size_before, size_after = storage.compress_entries()
+  print(f"Size of summary and contents: {size_before} -> {size_after} bytes")
+  if args.vacuum:
+    print("Vacuuming database...")
+    storage.db.execute("VACUUM")
+    # rowid might change after vacuum
+    storage.rebuild_search_index()
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Maintenance commands for LFReader database and archives",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+  )
+  parser.add_argument("-c", "--config", default=os.getenv("LFREADER_CONFIG", ""), help="Config file path")
+  subparsers = parser.add_subparsers(required=True)
+
+  p = subparsers.add_parser("rebuild-search-index", help="Rebuild full-text search index of entries")
+  p.set_defaults(func=rebuild_search_index)
+
+  p = subparsers.add_parser("dedup-archives", help="Replace archived files of the same content with hard links")
+  p.add_argument("-n", "--dry-run", action="store_true", help="Only report duplicate files")
+  p.set_defaults(func=dedup_archives)
+
+  p = subparsers.add_parser("gc-archives", help="Delete archived files not referenced by any resource")
+  p.add_argument("-n", "--dry-run", action="store_true", help="Only report orphan files and their size")
+  p.set_defaults(func=gc_archives)
+
+  p = subparsers.add_parser(
+    "prune-changes",
+    help="Delete tombstones of deleted feeds and entries from change log (clients synced before them must sync again)"
+  )
+  p.add_argument("--before-seq", type=int, help="Only delete tombstones up to this seq (default: all)")
+  p.set_defaults(func=prune_changes)
+
+  p = subparsers.add_parser(
+    "compress-entries",
+    help="Compress (or decompress) summary and contents of existing entries according to compression_threshold in config"
+  )
+  p.add_argument("--vacuum", action="store_true", help="Vacuum database afterwards to reclaim space")
+  p.set_defaults(func=compress_entries)
+
+  args = parser.parse_args()
+
+  try:
+    if args.config:
+      with open(args.config) as f:
+        config = Config(**json.load(f))
+    else:
+      config = Config()
+  except ValidationError as e:
+    print(e.errors())
+    sys.exit(1)
+
+  logging.basicConfig(level=config.log_level.upper())
+  args.func(Storage(config), args)
+
+if __name__ == "__main__":
+  main()
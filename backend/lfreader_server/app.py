@@ -14,10 +14,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.openapi.docs import (
   get_swagger_ui_html,
   get_swagger_ui_oauth2_redirect_html
@@ -32,12 +33,20 @@ from typing import Annotated
 import traceback
 import uvicorn
 import json
+import hashlib
+from functools import partial
 from enum import Enum
 import asyncio
+from contextlib import asynccontextmanager
 
 from .storage import Storage
+from .scheduler import Scheduler
+from .jobs import JobQueue
+from .events import EventBroker, format_sse
+from .metrics import MetricsMiddleware, render_metrics
+from .profiling import ProfilerMiddleware, profiling
 from .config import Config
-from .models import AppState, AppStatus, QueryEntriesArgs, FetchFeedsArgs, ArchiveFeedsArgs, CleanFeedsArgs, DeleteFeedsArgs, UpdateFeedsArgs, UpdateEntriesArgs
+from .models import AppState, AppStatus, JobInfo, FeedInfo, QueryEntriesArgs, EntriesPage, SearchEntriesArgs, Changes, FetchFeedsArgs, ArchiveFeedsArgs, CleanFeedsArgs, DeleteFeedsArgs, UpdateFeedsArgs, CollectGarbageArgs, UpdateEntriesArgs
 
 
 try:
@@ -55,25 +64,142 @@ logging.basicConfig(level=config.log_level.upper())
 if config_file:
   logging.info(f"Config file loaded: {config_file}")
 
-app = FastAPI(root_path="/api", docs_url=None, redoc_url=None)
-state = AppState()
+events = EventBroker()
+state = AppState(lambda status: events.publish("status", status.model_dump_json()))
 storage = Storage(config)
 
-async def taskRunner(task):
-  try:
-    await task()
-  except Exception as e:
-    logging.error(f"Error occurred: {str(e)}")
-    traceback.print_exc()
-  finally:
-    state.status.loading = False
+"""
+Keep loading status in sync with jobs and notify clients of job progress
+"""
+def on_job_change(job: JobInfo):
+  events.publish("job", job.model_dump_json())
+  if job.finished_at is not None:
+    state.status.loading = len(jobs.active()) > 0
     state.update()
+  else:
+    state.set_loading(True)
+
+jobs = JobQueue(on_job_change)
+
+"""
+Wrap func of a job to profile it if enabled
+"""
+def profiled_job(func):
+  if not config.debug.profile_jobs:
+    return func
+  async def run(job: JobInfo):
+    with profiling(f"job {job.id} ({job.action})", config.debug.profile_dir, config.debug.profile_top):
+      await func(job)
+  return run
+
+"""
+Resolve all feeds (None) to the feeds existing now
+so that jobs on all feeds don't block jobs on feeds added later
+"""
+async def existing_feed_urls(feed_urls: list[str] | None) -> list[str]:
+  if feed_urls:
+    return feed_urls
+  return [f["url"] for f in await storage.read(storage.get_feeds, None, ["url"])]
+
+"""
+Submit a job to fetch feeds with user data to save,
+or feeds of feed_urls with their user data in db (all existing feeds if neither is specified)
+"""
+async def submit_fetch_job(
+  feeds: list[FeedInfo] | None,
+  archive: bool,
+  force_archive: bool,
+  ignore_error: bool,
+  feed_urls: list[str] | None = None
+) -> JobInfo:
+  feed_urls = await existing_feed_urls([f["url"] for f in feeds] if feeds else feed_urls)
+  async def run(job: JobInfo):
+    await storage.fetch_feeds(feeds or None, archive, force_archive, ignore_error, partial(jobs.progress, job), feed_urls)
+
+  return jobs.submit(
+    "fetch",
+    feed_urls,
+    {"archive": archive, "force_archive": force_archive, "ignore_error": ignore_error},
+    profiled_job(run),
+    # user data in request is saved as well
+    {f["url"]: f["user_data"] for f in feeds} if feeds else None
+  )
+
+"""
+Submit a job to archive feeds (all existing feeds if not specified)
+"""
+async def submit_archive_job(feed_urls: list[str] | None) -> JobInfo:
+  feed_urls = await existing_feed_urls(feed_urls)
+  return jobs.submit(
+    "archive",
+    feed_urls,
+    {},
+    profiled_job(lambda job: storage.archive_feeds(feed_urls, partial(jobs.progress, job)))
+  )
+
+"""
+Submit a job to delete archived files not referenced by any resource
+(it waits for all other jobs as they might be archiving files)
+"""
+def submit_gc_job(dry_run: bool) -> JobInfo:
+  async def run(job: JobInfo):
+    count, size = await storage.archiver.collect_garbage(dry_run, progress=partial(jobs.progress, job))
+    job.result = {"files": count, "bytes": size}
+  return jobs.submit("gc", None, {"dry_run": dry_run}, profiled_job(run))
+
+"""
+Fetch due feeds in background
+"""
+async def refresh_feeds(feeds: list[dict]):
+  # only submit urls as user data might be updated before the job runs
+  job = await submit_fetch_job(None, config.scheduler.archive, False, True, [f["url"] for f in feeds])
+  # wait for the job to avoid submitting the same feeds again
+  await jobs.wait(job)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  scheduler = None
+  if config.scheduler.enabled:
+    scheduler = asyncio.create_task(
+      Scheduler(config.scheduler, lambda: storage.read(storage.get_due_feeds), refresh_feeds).run()
+    )
+  yield
+  if scheduler:
+    scheduler.cancel()
+  await storage.close()
+
+app = FastAPI(root_path="/api", docs_url=None, redoc_url=None, lifespan=lifespan)
+if config.gzip_min_size is not None:
+  app.add_middleware(GZipMiddleware, minimum_size=config.gzip_min_size)
+if config.metrics:
+  app.add_middleware(MetricsMiddleware)
+if config.debug.profile_requests:
+  app.add_middleware(ProfilerMiddleware, output_dir=config.debug.profile_dir, top=config.debug.profile_top)
 
-def runLoadingTask(task):
-  if state.status.loading:
-    raise HTTPException(status_code=409, detail="Server is already loading data")
-  state.status.loading = True
-  asyncio.create_task(taskRunner(task))
+"""
+Compute ETag of a read API response from the data version and request args
+"""
+async def data_etag(*args):
+  # change log covers feeds and entries while updated time covers server data
+  seq = await storage.read(storage.latest_change)
+  key = json.dumps([seq, state.status.updated, *args], default=str)
+  # weak ETag as the response might be compressed
+  return f'W/"{hashlib.blake2s(key.encode(), digest_size=16).hexdigest()}"'
+
+"""
+Return 304 response if client already has the response of the ETag
+"""
+def not_modified(request: Request, etag: str) -> Response | None:
+  tags = [t.strip() for t in request.headers.get("if-none-match", "").split(",")]
+  if etag in tags or "*" in tags:
+    return Response(status_code=304, headers={"ETag": etag})
+  return None
+
+# interval (in seconds) to send keepalive comments in event stream
+SSE_KEEPALIVE = 30
+
+# ask client to revalidate cached responses before using them
+CACHE_HEADERS = {"Cache-Control": "no-cache"}
 
 
 # self-host js and css assets for Swagger UI
@@ -101,20 +227,108 @@ async def get_status_api() -> AppStatus:
   return state.status
 
 
+"""
+Stream server status and job progress as Server-Sent Events
+"""
+@app.get("/events")
+async def events_api():
+  async def content():
+    with events.subscribe() as queue:
+      # send current status first so that clients can sync up
+      yield format_sse("status", state.status.model_dump_json())
+      while True:
+        try:
+          event, data = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE)
+        except asyncio.TimeoutError:
+          # comment to keep connection alive
+          yield ": keepalive\n\n"
+          continue
+        yield format_sse(event, data)
+
+  return StreamingResponse(content(), media_type="text/event-stream", headers={
+    "Cache-Control": "no-cache",
+    # disable buffering in reverse proxy (e.g. nginx)
+    "X-Accel-Buffering": "no"
+  })
+
+
+"""
+Get metrics in Prometheus text format
+"""
+@app.get("/metrics", include_in_schema=False)
+async def metrics_api():
+  if not config.metrics:
+    raise HTTPException(status_code=404, detail="Metrics disabled")
+  return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+"""
+Get recent jobs
+"""
+@app.get("/jobs")
+async def get_jobs_api() -> list[JobInfo]:
+  return list(jobs.jobs.values())
+
+
+"""
+Get a job by id
+"""
+@app.get("/jobs/{job_id}")
+async def get_job_api(job_id: int) -> JobInfo:
+  job = jobs.get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+  return job
+
+
 """
 Get feeds from local database
 """
 @app.get("/feeds")
-async def get_feeds_api() -> list[dict]:
-  return storage.get_feeds()
+async def get_feeds_api(request: Request, response: Response) -> list[dict]:
+  etag = await data_etag("feeds")
+  if r := not_modified(request, etag):
+    return r
+  response.headers.update({"ETag": etag, **CACHE_HEADERS})
+  return await storage.read(storage.get_feeds)
 
 
 """
 Query entries from local database
 """
 @app.post("/entries/query")
-async def query_entries_api(args: QueryEntriesArgs) -> list[dict]:
-  return storage.get_entries(args.feed_urls, args.entries, args.offset, args.limit, args.columns)
+async def query_entries_api(args: QueryEntriesArgs) -> list[dict] | EntriesPage:
+  if args.cursor is not None:
+    return await storage.read(storage.get_entries_page, args.feed_urls, args.entries, args.cursor, args.limit, args.columns)
+
+  # stream rows in JSON directly to reduce memory usage and latency
+  chunks = storage.stream(storage.get_entries_json, args.feed_urls, args.entries, args.offset, args.limit, args.columns)
+  # get first chunk to raise errors before sending response
+  first = await anext(chunks)
+  async def content():
+    yield first
+    async for chunk in chunks:
+      yield chunk
+  return StreamingResponse(content(), media_type="application/json")
+
+
+"""
+Full-text search entries in local database
+"""
+@app.post("/entries/search")
+async def search_entries_api(args: SearchEntriesArgs) -> list[dict]:
+  return await storage.read(storage.search_entries, args.query, args.feed_urls, args.offset, args.limit, args.columns)
+
+
+"""
+Get feeds and entries changed after a change sequence (0 to get all)
+"""
+@app.get("/changes")
+async def get_changes_api(
+  since: Annotated[int, Query(ge=0)] = 0,
+  columns: Annotated[list[str] | None, Query()] = None
+) -> Changes:
+  return await storage.read(storage.get_changes, since, columns)
 
 
 """
@@ -127,25 +341,39 @@ async def feed_action_api(
   match args.action:
     case "fetch":
       # Fetch feeds and their entries from origin (can be new feeds)
-      runLoadingTask(lambda: storage.fetch_feeds(args.feeds, args.archive, args.force_archive, args.ignore_error))
+      return {"job_id": (await submit_fetch_job(args.feeds, args.archive, args.force_archive, args.ignore_error)).id}
     case "archive":
-      runLoadingTask(lambda: storage.archive_feeds(args.feed_urls))
+      return {"job_id": (await submit_archive_job(args.feed_urls)).id}
     case "delete":
       if args.feed_urls is None:
         raise HTTPException(status_code=400, detail=f"Invalid delete action: feed_urls not specified")
-      storage.delete_feeds(args.feed_urls)
+      await storage.write(storage.delete_feeds, args.feed_urls)
       state.update()
     case "clean":
-      storage.clean_feeds(args.feed_urls)
+      await storage.write(storage.clean_feeds, args.feed_urls)
       state.update()
     case "update":
-      storage.update_feeds(args.feeds)
+      await storage.write(storage.update_feeds, args.feeds)
       state.update()
     case _:
       raise HTTPException(status_code=400, detail=f"Invalid feed action: {args.action}")
   return {}
 
 
+"""
+Archive Action API
+"""
+@app.post("/archives")
+async def archive_action_api(
+  args: CollectGarbageArgs
+):
+  match args.action:
+    case "gc":
+      return {"job_id": submit_gc_job(args.dry_run).id}
+    case _:
+      raise HTTPException(status_code=400, detail=f"Invalid archive action: {args.action}")
+
+
 """
 Entry Action API
 """
@@ -155,7 +383,7 @@ async def entry_action_api(
 ):
   match args.action:
     case "update":
-      storage.update_entries(args.entries)
+      await storage.write(storage.update_entries, args.entries)
       state.update()
     case _:
       raise HTTPException(status_code=400, detail=f"Invalid entry action: {args.action}")
@@ -15,6 +15,9 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from bs4 import BeautifulSoup
+from bs4.builder import HTMLTreeBuilder
+from html.parser import HTMLParser
+from html import escape
 from datetime import datetime
 import random
 import logging
@@ -23,18 +26,259 @@ from urllib.parse import urlparse
 from hashlib import blake2s
 from pathlib import Path
 import shutil
+import os
 import asyncio
 from yarl import URL
 from functools import partial
 import re
+import time
+import json
+from typing import Iterable, Callable
+from concurrent.futures import ThreadPoolExecutor
 
-from .config import ArchiverConfig
+from .config import ArchiverConfig, ArchiveOption
 from .utils import async_map, sql_update_field
+from .metrics import (
+  HTML_REWRITE_SECONDS, HTML_REWRITE_SKIPPED, RESOURCE_DOWNLOADS,
+  RESOURCE_DOWNLOAD_SECONDS, RESOURCE_DOWNLOAD_BYTES, RESOURCE_RETRIES
+)
+
+# attrs whose values are whitespace-separated lists (e.g. class) by tag ("*" for all tags)
+MULTI_VALUED_ATTRS = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+
+def is_multi_valued(tag: str, attr: str) -> bool:
+  return attr in MULTI_VALUED_ATTRS.get("*", ()) or attr in MULTI_VALUED_ATTRS.get(tag, ())
+
+def match_filter(f: re.Pattern | list[str] | bool, value: str | None, multi_valued: bool = False) -> bool:
+  """
+  Match tag name or attr value against filter the same way as BeautifulSoup
+  (a multi-valued attr matches if any of its values or the whole value matches)
+  """
+  if f is True or f is False:
+    return (value is not None) == f
+  if value is None:
+    return False
+  if multi_valued:
+    values = value.split()
+    if any(match_filter(f, v) for v in values):
+      return True
+    value = " ".join(values)
+  if isinstance(f, re.Pattern):
+    return f.search(value) is not None
+  return value in f
+
+class ResourceTagParser(HTMLParser):
+  """
+  Find start tags matching archive options without building a tree.
+  matches are (offset of tag, raw tag text, tag, attrs, attrs to archive)
+  """
+  def __init__(self, options: list[ArchiveOption]):
+    super().__init__(convert_charrefs=True)
+    self.options = options
+    self.matches = []
+
+  def handle_starttag(self, tag, attrs):
+    values = dict(attrs)
+    archive_attrs = [
+      opt.attr for opt in self.options
+      if values.get(opt.attr)
+      and match_filter(opt.tag_filter, tag)
+      and all(match_filter(f, values.get(k), is_multi_valued(tag, k)) for k, f in opt.attr_filters.items())
+    ]
+    if archive_attrs:
+      self.matches.append((self.getpos(), self.get_starttag_text(), tag, attrs, archive_attrs))
+
+  handle_startendtag = handle_starttag
+
+# serialize html parsed by BeautifulSoup
+def soup_to_html(soup: BeautifulSoup, content: str) -> str:
+  # lxml wraps html fragments in <html><head>...</head><body>...</body></html>
+  if soup.html is not None and not re.search(r"<(html|head|body)[\s>]", content, re.IGNORECASE):
+    return "".join(str(c) for el in (soup.head, soup.body) if el is not None for c in el.contents)
+  return str(soup)
+
+def format_starttag(tag: str, attrs: list[tuple[str, str | None]], self_closing: bool):
+  attrs_text = "".join(f" {k}" if v is None else f' {k}="{escape(v)}"' for k, v in attrs)
+  return f"<{tag}{attrs_text}{' /' if self_closing else ''}>"
+
+# size of data buffered before writing to file
+WRITE_BUFFER_SIZE = 1 << 20
+
+# file in archive dir touched by other processes (e.g. lfreader-admin) after changing archived files
+# so that the running server reloads its file index (archived files never start with a dot)
+INDEX_STAMP = ".index-stamp"
+
+# number of threads to stat archived files in garbage collection
+GC_WORKERS = 8
+# files modified within this time (in seconds) are not collected as they might be being archived
+GC_MIN_AGE = 60 * 60
+
+class FileWriter:
+  """
+  Write file in a thread to avoid blocking event loop.
+  Data is buffered to reduce the number of thread switches.
+  """
+  def __init__(self, path: Path, append: bool, fsync: bool):
+    self.path = path
+    self.mode = "ab" if append else "wb"
+    self.fsync = fsync
+    self.buffer = []
+    self.buffered = 0
+
+  async def __aenter__(self):
+    self.f = await asyncio.to_thread(open, self.path, self.mode)
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    try:
+      # write remaining data even on error so that it can be resumed
+      await self.flush()
+      if self.fsync and exc_type is None:
+        await asyncio.to_thread(os.fsync, self.f.fileno())
+    finally:
+      await asyncio.to_thread(self.f.close)
+
+  async def write(self, data: bytes):
+    self.buffer.append(data)
+    self.buffered += len(data)
+    if self.buffered >= WRITE_BUFFER_SIZE:
+      await self.flush()
+
+  async def flush(self):
+    if not self.buffer:
+      return
+    data = b"".join(self.buffer)
+    self.buffer = []
+    self.buffered = 0
+    await asyncio.to_thread(self.f.write, data)
+
+# move file into place atomically (and persist the rename if fsync is enabled)
+def replace_file(src: Path, dst: Path, fsync: bool):
+  os.replace(src, dst)
+  if fsync:
+    fd = os.open(dst.parent, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+class ResourceTooLarge(Exception):
+  pass
+
+# total size of resource from response (None if unknown)
+def response_total_size(resp) -> int | None:
+  if resp.status == 206:
+    m = re.match(r"bytes \d+-\d+/(\d+)", resp.headers.get("Content-Range", ""))
+    return m and int(m[1])
+  return resp.content_length
+
+# start offset of partial content (None if not a valid partial response)
+def response_offset(resp) -> int | None:
+  m = re.match(r"bytes (\d+)-", resp.headers.get("Content-Range", ""))
+  return m and int(m[1])
+
+# validator for If-Range (weak ETag can't be used)
+def response_validator(resp) -> str | None:
+  etag = resp.headers.get("ETag")
+  if etag and not etag.startswith("W/"):
+    return etag
+  return resp.headers.get("Last-Modified")
+
+# size, digest and validator of partial download left by previous runs
+# (empty state if it can't be resumed)
+def load_partial_download(download_path: Path, validator_path: Path):
+  try:
+    validator = validator_path.read_text()
+    digest = blake2s()
+    size = 0
+    with open(download_path, "rb") as f:
+      while chunk := f.read(1 << 20):
+        digest.update(chunk)
+        size += len(chunk)
+    return size, digest, validator
+  except FileNotFoundError:
+    return 0, blake2s(), None
+
+def remove_partial_download(download_path: Path, validator_path: Path):
+  download_path.unlink(missing_ok=True)
+  validator_path.unlink(missing_ok=True)
+
+# size of file (None if it doesn't exist)
+def file_size(path: Path) -> int | None:
+  try:
+    return path.stat().st_size
+  except FileNotFoundError:
+    return None
+
+# save validator of partial download (removed if the response has none)
+def save_validator(validator_path: Path, validator: str | None):
+  if validator:
+    validator_path.write_text(validator)
+  else:
+    validator_path.unlink(missing_ok=True)
 
 class Archiver:
-  def __init__(self, db, config: ArchiverConfig):
+  def __init__(self, db, config: ArchiverConfig, write):
     self.db = db
     self.cfg = config
+    # function to run db writes in writer thread
+    self.write = write
+    # ongoing downloads by url
+    self.downloads: dict[str, asyncio.Future] = {}
+    # references to archived resources (entry_id, url, filename) by feed url
+    # (saved with the entries so that both are committed or discarded together)
+    self.pending_resources: dict[str, list[tuple[str, str, str | None]]] = {}
+    # names of archived files to avoid checking file system
+    self.files_stamp = self.index_stamp()
+    self.files = self.load_files() if config.file_index else None
+    # attrs to archive in html (to skip parsing html without them)
+    self.attrs_pattern = re.compile(
+      "|".join(rf"\s{re.escape(opt.attr)}\s*=" for opt in config.archive_options) or "(?!)",
+      re.I
+    )
+
+  def load_files(self) -> set[str]:
+    if not os.path.isdir(self.cfg.base_dir):
+      return set()
+    with os.scandir(self.cfg.base_dir) as it:
+      files = set(e.name for e in it if not e.name.endswith(".part") and not e.name.startswith("."))
+    logging.info(f"Loaded index of {len(files)} archived files")
+    return files
+
+  # modified time of index stamp (None if it doesn't exist)
+  def index_stamp(self) -> int | None:
+    try:
+      return os.stat(os.path.join(self.cfg.base_dir, INDEX_STAMP)).st_mtime_ns
+    except FileNotFoundError:
+      return None
+
+  # notify running server that archived files have changed
+  def touch_index_stamp(self):
+    if os.path.isdir(self.cfg.base_dir):
+      Path(self.cfg.base_dir).joinpath(INDEX_STAMP).touch()
+
+  # reload file index if archived files were changed by other processes (run in a thread)
+  def refresh_index(self):
+    if self.files is None:
+      return
+    stamp = self.index_stamp()
+    if stamp != self.files_stamp:
+      logging.info("Archived files changed by other processes. Reloading file index...")
+      self.files_stamp = stamp
+      self.files = self.load_files()
+
+  def file_exists(self, filename: str) -> bool:
+    if self.files is None:
+      return Path(self.cfg.base_dir).joinpath(filename).exists()
+    return filename in self.files
+
+  def add_file(self, filename: str):
+    if self.files is not None:
+      self.files.add(filename)
+
+  def remove_file(self, filename: str):
+    if self.files is not None:
+      self.files.discard(filename)
 
   def filename_from_url(self, url: str):
     name = Path(url).name
@@ -47,13 +291,33 @@ class Archiver:
     digest = blake2s(url.encode()).hexdigest()
     return  f"{digest}{ext}"
 
+  def content_filename(self, digest: str, url: str):
+    # ignore query in url to avoid duplicates of the same content
+    ext = Path(urlparse(url).path).suffix
+    if len(ext) > 8:
+      ext = ""
+    return f"{digest}{ext}"
+
   """
   Archive all resources in the html content
   and replace the URLs
   """
   async def archive_html(self, session, feed_url: str, entry_id: str, content: str, base_url: str | None, user_data: dict):
-    soup = BeautifulSoup(content, "html.parser")
+    # skip parsing if no attr to archive appears in html
+    if not content or not self.attrs_pattern.search(content):
+      HTML_REWRITE_SKIPPED.inc()
+      return content
+    if self.cfg.html_engine == "tokenizer":
+      return await self.archive_html_tokenizer(session, feed_url, entry_id, content, base_url, user_data)
+
+    # time of parsing and rewriting (excluding archiving resources)
+    timer = time.perf_counter()
+    soup = BeautifulSoup(content, self.cfg.html_engine)
+    rewrite_time = time.perf_counter() - timer
     async def update_tag(attr, tag):
+      # skip empty urls (same as tokenizer) as they refer to the page itself
+      if not tag.get(attr):
+        return
       resource_url = await self.archive_resource(session, feed_url, entry_id, tag.get(attr), base_url, user_data)
       # only update url when archiving succeeds
       if resource_url:
@@ -63,22 +327,76 @@ class Archiver:
       attrs = opt.attr_filters
       if opt.attr not in attrs:
         attrs[opt.attr] = True
+      timer = time.perf_counter()
+      tags = soup.find_all(opt.tag_filter, attrs=attrs)
+      rewrite_time += time.perf_counter() - timer
       await async_map(
         partial(update_tag, opt.attr),
-        soup.find_all(opt.tag_filter, attrs=attrs),
+        tags,
         user_data.get("archive_sequential", False),
         user_data.get("archive_interval", 0)
       )
-    return str(soup)
+    timer = time.perf_counter()
+    result = soup_to_html(soup, content)
+    HTML_REWRITE_SECONDS.observe(rewrite_time + time.perf_counter() - timer, engine=self.cfg.html_engine)
+    return result
+
+  """
+  Archive resources in html by rewriting matched start tags only
+  so that the rest of html is kept as it is
+  """
+  async def archive_html_tokenizer(self, session, feed_url: str, entry_id: str, content: str, base_url: str | None, user_data: dict):
+    # time of parsing and rewriting (excluding archiving resources)
+    timer = time.perf_counter()
+    parser = ResourceTagParser(self.cfg.archive_options)
+    parser.feed(content)
+    parser.close()
+    rewrite_time = time.perf_counter() - timer
+    if not parser.matches:
+      HTML_REWRITE_SECONDS.observe(rewrite_time, engine="tokenizer")
+      return content
+
+    # new attr values of matched tags
+    new_values = [{} for _ in parser.matches]
+    async def update_attr(item):
+      i, attr = item
+      value = dict(parser.matches[i][3])[attr]
+      resource_url = await self.archive_resource(session, feed_url, entry_id, value, base_url, user_data)
+      # only update url when archiving succeeds
+      if resource_url:
+        new_values[i][attr] = resource_url
+
+    await async_map(
+      update_attr,
+      [(i, attr) for i, m in enumerate(parser.matches) for attr in dict.fromkeys(m[4])],
+      user_data.get("archive_sequential", False),
+      user_data.get("archive_interval", 0)
+    )
+
+    timer = time.perf_counter()
+    # offsets of lines to convert positions of tags
+    line_offsets = [0] + [m.end() for m in re.finditer("\n", content)]
+    parts = []
+    last = 0
+    for ((line, col), text, tag, attrs, _), values in zip(parser.matches, new_values):
+      start = line_offsets[line - 1] + col
+      if not values or content[start:start + len(text)] != text:
+        continue
+      parts.append(content[last:start])
+      parts.append(format_starttag(tag, [(k, values.get(k, v)) for k, v in attrs], text.endswith("/>")))
+      last = start + len(text)
+    parts.append(content[last:])
+    result = "".join(parts)
+    HTML_REWRITE_SECONDS.observe(rewrite_time + time.perf_counter() - timer, engine="tokenizer")
+    return result
 
   async def archive_resource(self, session, feed_url: str, entry_id: str, src: str, base_url: str | None, user_data: dict):
-    resource_dir = Path(self.cfg.base_dir)
     # check if url is already archived
     if src.startswith(self.cfg.base_url):
       filename = Path(src).name
       # start with 64 hex digit
       if re.match("[0-9a-f]{64}", filename):
-        if resource_dir.joinpath(filename).exists():
+        if self.file_exists(filename):
           # already archived
           return None
         logging.warn(f"URL archived but resource not found: {src}")
@@ -92,22 +410,19 @@ class Archiver:
       url = urljoin(user_base_url, base_path.removeprefix("/"))
 
     filename = self.filename_from_url(url)
-    resource_path = resource_dir.joinpath(filename)
     resource_url = f"{self.cfg.base_url}/{filename}"
 
-    # already cached
-    if resource_path.exists():
+    if self.cfg.content_addressed:
+      # content-addressed file is only known after downloading
+      content_filename = await self.write(self.get_resource_file, url)
+      if content_filename and self.file_exists(content_filename):
+        self.add_resource(feed_url, entry_id, url)
+        return f"{self.cfg.base_url}/{content_filename}"
+
+    # already cached (also used in content-addressed mode for files archived before)
+    if self.file_exists(filename):
       # add to resources table in case it was not added to db due to failure
-      self.db.execute(
-        f'''
-        INSERT OR IGNORE INTO resources VALUES (?, ?, ?)
-        ''',
-        (
-          feed_url,
-          entry_id,
-          url
-        )
-      )
+      self.add_resource(feed_url, entry_id, url)
       return resource_url
 
     # skip blacklisted url (regex)
@@ -115,71 +430,328 @@ class Archiver:
     if archive_blacklist and re.match(archive_blacklist, url):
       return None
 
+    # max size in bytes (0 for no limit)
+    max_size = user_data.get("max_resource_size", self.cfg.max_resource_size)
+
+    # share the download among concurrent requests of the same url
+    # (limits of the first request apply)
+    task = self.downloads.get(url)
+    if task is None:
+      task = asyncio.ensure_future(self.download_resource(session, url, filename, max_size, f"{url} ({user_base_url}, {base_url}, {src})"))
+      self.downloads[url] = task
+      task.add_done_callback(lambda _: self.downloads.pop(url, None))
+    # don't cancel the shared download if this request is cancelled
+    archived_filename = await asyncio.shield(task)
+    if archived_filename is None:
+      return None
+
+    # add to resources table
+    self.add_resource(feed_url, entry_id, url, archived_filename if self.cfg.content_addressed else None)
+    return f"{self.cfg.base_url}/{archived_filename}"
+
+  """
+  Download resource and return the archived filename (None if it fails)
+  """
+  async def download_resource(self, session, url: str, filename: str, max_size: int, source: str) -> str | None:
+    resource_dir = Path(self.cfg.base_dir)
+    resource_path = resource_dir.joinpath(filename)
+
+    # download to temp file first so that partial downloads are never treated as archived
+    download_path = resource_path.with_name(f"{filename}.part")
+    # validator of partial download for If-Range (with .part suffix to be skipped as well)
+    validator_path = resource_path.with_name(f"{filename}.validator.part")
+    # state of partial download for resuming (kept across runs)
+    size, digest, validator = await asyncio.to_thread(load_partial_download, download_path, validator_path)
+
     logging.debug(f'Archiving resource at {url}...')
-    for i in range(self.cfg.retry_attempts):
-      try:
-        # disable quoting to prevent invalid char in url
-        async with session.get(URL(url, encoded=True)) as resp:
-          resp.raise_for_status()
-          with open(resource_path, "wb") as f:
-            async for chunk in resp.content.iter_chunked(10240):
-              f.write(chunk)
-        # add to resources table
-        self.db.execute(
-          f'''
-          INSERT OR IGNORE INTO resources VALUES (?, ?, ?)
-          ''',
-          (
-            feed_url,
-            entry_id,
-            url
-          )
-        )
+    with RESOURCE_DOWNLOAD_SECONDS.time():
+      for i in range(self.cfg.retry_attempts):
+        try:
+          headers = {}
+          if size > 0 and validator:
+            # resume partial download (full resource is returned if it has changed)
+            headers["Range"] = f"bytes={size}-"
+            headers["If-Range"] = validator
+          # disable quoting to prevent invalid char in url
+          async with session.get(URL(url, encoded=True), headers=headers) as resp:
+            resp.raise_for_status()
+            if resp.status == 206:
+              if response_offset(resp) != size:
+                size = 0
+                digest = blake2s()
+                validator = None
+                raise ValueError(f"Unexpected range in partial response: {resp.headers.get('Content-Range')}")
+            else:
+              # download from beginning (resource changed if it was partially downloaded)
+              size = 0
+              digest = blake2s()
+              validator = response_validator(resp)
+              await asyncio.to_thread(save_validator, validator_path, validator)
+
+            # skip oversized resources before downloading
+            total_size = response_total_size(resp)
+            if max_size and total_size is not None and total_size > max_size:
+              raise ResourceTooLarge(f"size {total_size} exceeds limit {max_size}")
+
+            async with FileWriter(download_path, size > 0, self.cfg.fsync) as f:
+              async for chunk in resp.content.iter_chunked(10240):
+                # size might be unknown before downloading
+                if max_size and size + len(chunk) > max_size:
+                  raise ResourceTooLarge(f"size exceeds limit {max_size}")
+                await f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                RESOURCE_DOWNLOAD_BYTES.inc(len(chunk))
 
-        return resource_url
-      except Exception as e:
-        # delete partial downloads to prevent corruption
-        resource_path.unlink(missing_ok=True)
-
-        retry_status = "Retrying..." if i != self.cfg.retry_attempts - 1 else "All retries failed."
-        logging.warn(f"Failed to fetch resource from {url} ({user_base_url}, {base_url}, {src}): {type(e).__name__}: {str(e)}")
-        if i != self.cfg.retry_attempts - 1:
-          logging.info(f"Retrying to fetch resource from {url} ({user_base_url}, {base_url}, {src})...")
-          await asyncio.sleep(
-            self.cfg.retry_delay + random.randrange(self.cfg.retry_delay)
-          )
-        else:
-          logging.warn(f"Failed to fetch resource from {url} ({user_base_url}, {base_url}, {src}): All retries failed.")
+          await asyncio.to_thread(validator_path.unlink, missing_ok=True)
+          if self.cfg.content_addressed:
+            content_filename = self.content_filename(digest.hexdigest(), url)
+            content_path = resource_dir.joinpath(content_filename)
+            if self.file_exists(content_filename):
+              # same content already archived from another url
+              await asyncio.to_thread(download_path.unlink)
+            else:
+              await asyncio.to_thread(replace_file, download_path, content_path, self.cfg.fsync)
+              self.add_file(content_filename)
+            RESOURCE_DOWNLOADS.inc(result="ok")
+            return content_filename
+
+          await asyncio.to_thread(replace_file, download_path, resource_path, self.cfg.fsync)
+          self.add_file(filename)
+          RESOURCE_DOWNLOADS.inc(result="ok")
+          return filename
+        except ResourceTooLarge as e:
+          await asyncio.to_thread(remove_partial_download, download_path, validator_path)
+          RESOURCE_DOWNLOADS.inc(result="too_large")
+          logging.info(f"Skipped resource at {url}: {str(e)}")
+          return None
+        except Exception as e:
+          # keep partial download to resume if possible
+          # (unless some data failed to be written)
+          if (not validator or getattr(e, "status", None) == 416
+              or await asyncio.to_thread(file_size, download_path) != size):
+            size = 0
+            digest = blake2s()
+            await asyncio.to_thread(remove_partial_download, download_path, validator_path)
+
+          logging.warn(f"Failed to fetch resource from {source}: {type(e).__name__}: {str(e)}")
+          if i != self.cfg.retry_attempts - 1:
+            logging.info(f"Retrying to fetch resource from {source}...")
+            RESOURCE_RETRIES.inc()
+            await asyncio.sleep(
+              self.cfg.retry_delay + random.randrange(self.cfg.retry_delay)
+            )
+          else:
+            # partial download is kept to resume in later runs
+            logging.warn(f"Failed to fetch resource from {source}: All retries failed.")
+            RESOURCE_DOWNLOADS.inc(result="error")
 
     return None
 
-  # Delete resources (need to commit after calling this function)
-  def delete_resources(self, feed_url: str, entry_id: str | None = None):
-    cur = self.db.cursor()
-    query_condition = "feed_url = ?"
-    args = [feed_url]
-    if entry_id is not None:
-      query_condition += "AND entry_id = ?"
-      args.append(entry_id)
+  # Record reference to resource until it is saved with entries of the feed
+  # filename is only set for content-addressed files
+  def add_resource(self, feed_url: str, entry_id: str, url: str, filename: str | None = None):
+    self.pending_resources.setdefault(feed_url, []).append((entry_id, url, filename))
 
-    # keep track of deleted resources
-    resources = list(map(
-      lambda r: r["url"],
-      cur.execute(f"SELECT DISTINCT url FROM resources WHERE {query_condition}", args)
-    ))
+  # Save recorded references to resources of a feed (need to commit after calling this function)
+  def save_resources(self, feed_url: str):
+    resources = self.pending_resources.pop(feed_url, [])
+    self.db.executemany(
+      "INSERT OR IGNORE INTO resources VALUES (?, ?, ?)",
+      [(feed_url, entry_id, url) for entry_id, url, _ in resources]
+    )
+    self.db.executemany(
+      "INSERT OR REPLACE INTO resource_files VALUES (?, ?)",
+      [(url, filename) for _, url, filename in resources if filename is not None]
+    )
 
-    cur.execute(f"DELETE FROM resources WHERE {query_condition}", args)
+  # Discard recorded references to resources of a feed that failed to be saved
+  def discard_resources(self, feed_url: str):
+    self.pending_resources.pop(feed_url, None)
+
+  # names of files referenced by resources not saved yet
+  def pending_files(self) -> set[str]:
+    return set(
+      filename or self.filename_from_url(url)
+      for resources in list(self.pending_resources.values())
+      for _, url, filename in resources
+    )
+
+  # Get content-addressed filename of resource url
+  def get_resource_file(self, url: str) -> str | None:
+    r = self.db.execute("SELECT filename FROM resource_files WHERE url = ?", (url,)).fetchone()
+    return r and r["filename"]
+
+  """
+  Delete references to resources matching the condition (need to commit after calling this function).
+  Their urls are kept so that files no longer referenced can be deleted at once by delete_unreferenced_files.
+  """
+  def delete_resources_where(self, condition: str, args: Iterable = ()):
+    self.db.execute("CREATE TEMP TABLE IF NOT EXISTS deleted_resources (url TEXT PRIMARY KEY)")
+    self.db.execute(f"INSERT OR IGNORE INTO temp.deleted_resources SELECT url FROM resources WHERE {condition}", args)
+    self.db.execute(f"DELETE FROM resources WHERE {condition}", args)
+
+  """
+  Delete archived files of deleted resources that are no longer referenced
+  (need to commit after calling this function).
+  Return number of deleted files.
+  """
+  def delete_unreferenced_files(self) -> int:
+    self.db.execute("CREATE TEMP TABLE IF NOT EXISTS deleted_resources (url TEXT PRIMARY KEY)")
+    # keep urls without any reference
+    self.db.execute("DELETE FROM temp.deleted_resources WHERE url IN (SELECT url FROM resources)")
+    filenames = [
+      self.filename_from_url(r["url"])
+      for r in self.db.execute("SELECT url FROM temp.deleted_resources WHERE url NOT IN (SELECT url FROM resource_files)")
+    ]
+    content_filenames = [
+      r["filename"]
+      for r in self.db.execute("SELECT DISTINCT filename FROM resource_files WHERE url IN (SELECT url FROM temp.deleted_resources)")
+    ]
+    self.db.execute("DELETE FROM resource_files WHERE url IN (SELECT url FROM temp.deleted_resources)")
+    self.db.execute("DELETE FROM temp.deleted_resources")
+    # content-addressed file might be shared by other urls
+    shared = set(
+      r["filename"]
+      for r in self.db.execute(
+        "SELECT DISTINCT filename FROM resource_files WHERE filename IN (SELECT value FROM json_each(?))",
+        (json.dumps(content_filenames),)
+      )
+    )
+    filenames.extend(f for f in content_filenames if f not in shared)
 
     resource_dir = Path(self.cfg.base_dir)
-    for url in resources:
-      # short-circuit when it exists
-      r = cur.execute(
-        "SELECT EXISTS (SELECT 1 FROM resources WHERE url = ?) AS 'ok'",
-        (url,)
-      ).fetchone()
-      # delete resource if no reference
-      if r['ok'] == 0:
-        resource_path = resource_dir.joinpath(self.filename_from_url(url))
-        logging.info(f"Deleting resource {resource_path}...")
-        resource_path.unlink(missing_ok=True)
+    for filename in filenames:
+      resource_path = resource_dir.joinpath(filename)
+      logging.debug(f"Deleting resource {resource_path}...")
+      resource_path.unlink(missing_ok=True)
+      self.remove_file(filename)
+    if filenames:
+      logging.info(f"Deleted {len(filenames)} archived files")
+    return len(filenames)
+
+  # names of regular files in archive dir (including partial downloads)
+  def list_files(self) -> list[str]:
+    if not os.path.isdir(self.cfg.base_dir):
+      return []
+    with os.scandir(self.cfg.base_dir) as it:
+      return [e.name for e in it if e.is_file(follow_symlinks=False) and not e.name.startswith(".")]
+
+  # size and modified time of files (None if a file no longer exists)
+  def stat_files(self, filenames: list[str]) -> list[tuple[int, float] | None]:
+    def stat(filename: str):
+      try:
+        st = os.stat(os.path.join(self.cfg.base_dir, filename), follow_symlinks=False)
+        return st.st_size, st.st_mtime
+      except FileNotFoundError:
+        return None
+    with ThreadPoolExecutor(GC_WORKERS) as executor:
+      return list(executor.map(stat, filenames, chunksize=256))
+
+  # filter files not referenced by any resource
+  def find_orphan_files(self, filenames: list[str]) -> list[str]:
+    self.db.create_function("archive_filename", 1, self.filename_from_url, deterministic=True)
+    return [
+      r["filename"]
+      for r in self.db.execute(
+        '''
+        SELECT value AS filename FROM json_each(?)
+        WHERE value NOT IN (
+          SELECT COALESCE(resource_files.filename, archive_filename(resources.url))
+          FROM resources LEFT JOIN resource_files ON resource_files.url = resources.url
+        )
+        ''',
+        (json.dumps(filenames),)
+      )
+    ]
+
+  # delete orphan files and their stale mappings of content-addressed files
+  def delete_orphan_files(self, filenames: list[str]):
+    resource_dir = Path(self.cfg.base_dir)
+    for filename in filenames:
+      logging.debug(f"Deleting orphan file {filename}...")
+      resource_dir.joinpath(filename).unlink(missing_ok=True)
+      self.remove_file(filename)
+    self.db.execute(
+      "DELETE FROM resource_files WHERE filename IN (SELECT value FROM json_each(?))",
+      (json.dumps(filenames),)
+    )
+    self.db.commit()
+
+  """
+  Delete archived files not referenced by any resource
+  (e.g. left by interrupted downloads or old layouts of archive dir) in batches.
+  Recently modified files are kept as they might be being archived.
+  Return number of orphan files and their total size.
+  """
+  async def collect_garbage(
+    self,
+    dry_run: bool = False,
+    batch_size: int = 1000,
+    progress: Callable[[int, int], None] | None = None
+  ):
+    filenames = await asyncio.to_thread(self.list_files)
+    # find orphans in a single anti-join against all references
+    # files of resources being archived are not in db yet
+    pending = self.pending_files()
+    orphans = await self.write(self.find_orphan_files, [f for f in filenames if f not in pending])
+    stats = await asyncio.to_thread(self.stat_files, orphans)
+    deadline = time.time() - GC_MIN_AGE
+    orphans = [(f, st[0]) for f, st in zip(orphans, stats) if st and st[1] < deadline]
+    size = sum(s for _, s in orphans)
+    logging.info(f"Found {len(orphans)} orphan files ({size} bytes) in {len(filenames)} archived files")
+    if dry_run:
+      for f, s in orphans:
+        logging.info(f"Orphan file: {f} ({s} bytes)")
+      return len(orphans), size
+
+    for i in range(0, len(orphans), batch_size):
+      await self.write(self.delete_orphan_files, [f for f, _ in orphans[i:i + batch_size]])
+      if progress:
+        progress(min(i + batch_size, len(orphans)), len(orphans))
+    return len(orphans), size
+
+  """
+  Deduplicate archived files with the same content by replacing them with hard links
+  so that existing references to them still work.
+  Return number of deduplicated files and reclaimed bytes.
+  """
+  def dedup_files(self, dry_run: bool = False):
+    # only files of the same size could be duplicates
+    files_by_size = {}
+    with os.scandir(self.cfg.base_dir) as it:
+      for entry in it:
+        if entry.is_file(follow_symlinks=False) and not entry.name.endswith(".part") and not entry.name.startswith("."):
+          files_by_size.setdefault(entry.stat().st_size, []).append(entry)
+
+    count = 0
+    reclaimed = 0
+    for size, entries in files_by_size.items():
+      if len(entries) < 2:
+        continue
+      files_by_digest = {}
+      for entry in entries:
+        digest = blake2s()
+        with open(entry.path, "rb") as f:
+          while chunk := f.read(1 << 20):
+            digest.update(chunk)
+        files_by_digest.setdefault(digest.digest(), []).append(entry)
+
+      for entries in files_by_digest.values():
+        origin = entries[0]
+        for entry in entries[1:]:
+          # already linked
+          if entry.inode() == origin.inode():
+            continue
+          count += 1
+          reclaimed += size
+          if dry_run:
+            logging.info(f"Duplicate file: {entry.path} (same as {origin.name})")
+            continue
+          logging.info(f"Linking duplicate file {entry.path} to {origin.name}...")
+          # replace atomically
+          tmp_path = f"{entry.path}.part"
+          os.link(origin.path, tmp_path)
+          os.replace(tmp_path, entry.path)
+    return count, reclaimed
 
@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
+from typing import Literal
 import re
 
 class ArchiveOption(BaseModel):
@@ -14,6 +15,22 @@ class ArchiverConfig(BaseModel):
   base_dir: str = "archives"
   # base url to rewrite for archived resources
   base_url: str = "/archives"
+  # name archived files by hash of their content instead of url
+  # to store resources with the same content only once
+  content_addressed: bool = False
+  # keep names of archived files in memory to avoid checking file system
+  # (reloaded by jobs after lfreader-admin changes files; disable it if files are changed by other tools while running)
+  file_index: bool = True
+  # engine to find and rewrite resource urls in html
+  # tokenizer: only rewrite matched tags without building a tree (fastest)
+  # html.parser/lxml: parse whole html with BeautifulSoup using the parser (lxml must be installed)
+  html_engine: Literal["tokenizer", "html.parser", "lxml"] = "tokenizer"
+  # flush archived files to disk before renaming them into place
+  # (safer on power loss but slower)
+  fsync: bool = False
+  # max size (in bytes) of each archived resource (0 for no limit)
+  # larger resources are skipped (can be overridden by max_resource_size in feed user data)
+  max_resource_size: int = 0
   retry_attempts: int = 5
   # delay in seconds
   retry_delay: int = 5
@@ -21,17 +38,80 @@ class ArchiverConfig(BaseModel):
     ArchiveOption(attr="src")
   ]
 
+  # fail early instead of failing to archive every entry
+  @field_validator("html_engine")
+  @classmethod
+  def check_html_engine(cls, value: str):
+    if value == "lxml":
+      try:
+        import lxml
+      except ImportError:
+        raise ValueError("lxml must be installed to use it as html_engine")
+    return value
+
+class SchedulerConfig(BaseModel):
+  # refresh feeds in background according to how often they publish
+  enabled: bool = False
+  # bounds of refresh interval of each feed (in seconds)
+  min_interval: int = 15 * 60
+  max_interval: int = 24 * 60 * 60
+  # max fraction of refresh interval randomly added or subtracted
+  jitter: float = 0.1
+  # interval to check for due feeds (in seconds)
+  check_interval: int = 60
+  # whether to archive resources of refreshed feeds
+  archive: bool = True
+
+class DebugConfig(BaseModel):
+  # log sql statements taking at least this long (in milliseconds) with their query plans (0 to disable)
+  slow_query_ms: int = 0
+  # allow profiling API requests with header "X-Profile: 1"
+  profile_requests: bool = False
+  # profile all background jobs (fetching and archiving feeds)
+  profile_jobs: bool = False
+  # dir to save profiles in pstats format (only logged if not set)
+  profile_dir: str | None = None
+  # number of functions with most cumulative time to log in profiles
+  profile_top: int = 30
+
 class SwaggerConfig(BaseModel):
   js_url: str = "https://unpkg.com/swagger-ui-dist@5.16.0/swagger-ui-bundle.js"
   css_url: str = "https://unpkg.com/swagger-ui-dist@5.16.0/swagger-ui.css"
 
 class Config(BaseModel):
   db_file: str = "db.sqlite"
+  # number of read-only connections to query db concurrently
+  db_readers: int = 4
+  # number of read-only connections to stream large query results to clients
+  # (kept apart from readers as slow clients hold them until they finish)
+  db_streams: int = 4
+  # compress summary and contents of entries in db if their size (in bytes) reaches it
+  # (0 to disable compression; use lfreader-admin compress-entries to convert existing entries)
+  compression_threshold: int = 0
   # user agent used to fetch feeds and resources
   user_agent: str | None = None
   # timeout for establishing connection (in seconds)
   timeout: int = 10
+  # max number of feeds fetched concurrently (0 for no limit)
+  fetch_limit: int = 20
+  # max number of feeds fetched concurrently from the same host (0 for no limit)
+  fetch_limit_per_host: int = 2
+  # max number of open connections for feeds and resources (0 for no limit)
+  connection_limit: int = 100
+  # ttl of cached DNS results (in seconds)
+  dns_cache_ttl: int = 300
+  # executor to parse feeds off the event loop
+  # (falls back to thread if process pool is unavailable)
+  parser_executor: Literal["process", "thread"] = "process"
+  # max number of workers to parse feeds (None to decide by number of CPUs)
+  parser_workers: int | None = None
+  # min size (in bytes) of responses to compress with gzip (None to disable compression)
+  gzip_min_size: int | None = 1000
+  # record timings and counters of fetching, archiving and API requests (exported at /metrics)
+  metrics: bool = True
   log_level: str = "info"
   archiver: ArchiverConfig = ArchiverConfig()
+  scheduler: SchedulerConfig = SchedulerConfig()
+  debug: DebugConfig = DebugConfig()
   swagger: SwaggerConfig = SwaggerConfig()
 
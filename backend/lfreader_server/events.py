@@ -0,0 +1,52 @@
+# LFReader
+# Copyright (C) 2022-2025  DCsunset
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from contextlib import contextmanager
+from typing import Iterator
+
+# max number of events queued for a client before dropping old ones
+MAX_QUEUED_EVENTS = 100
+
+class EventBroker:
+  """
+  Broadcast events to subscribed clients
+  """
+  def __init__(self):
+    self.queues: set[asyncio.Queue] = set()
+
+  def publish(self, event: str, data: str):
+    for q in self.queues:
+      if q.full():
+        # drop oldest event for slow clients
+        q.get_nowait()
+      q.put_nowait((event, data))
+
+  """
+  Subscribe to events with a queue of (event, data)
+  """
+  @contextmanager
+  def subscribe(self) -> Iterator[asyncio.Queue]:
+    q = asyncio.Queue(MAX_QUEUED_EVENTS)
+    self.queues.add(q)
+    try:
+      yield q
+    finally:
+      self.queues.remove(q)
+
+# format event in Server-Sent Events
+def format_sse(event: str, data: str):
+  return f"event: {event}\ndata: {data}\n\n"
@@ -0,0 +1,130 @@
+# LFReader
+# Copyright (C) 2022-2025  DCsunset
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from .models import JobInfo
+
+# max number of finished jobs to keep
+MAX_FINISHED_JOBS = 100
+
+def now_iso():
+  return datetime.now().astimezone().isoformat()
+
+def overlap(a: list[str] | None, b: list[str] | None):
+  # None denotes all feeds
+  return a is None or b is None or not set(a).isdisjoint(b)
+
+def covers(a: list[str] | None, b: list[str] | None):
+  return a is None or (b is not None and set(b).issubset(a))
+
+def same_feeds(a: list[str] | None, b: list[str] | None):
+  return a == b or (a is not None and b is not None and set(a) == set(b))
+
+
+class JobQueue:
+  """
+  Run jobs on disjoint feeds concurrently.
+  A job waits for earlier active jobs on overlapping feeds to finish.
+  Duplicate jobs (same action, options and extra data) are merged into a pending job that covers their feeds
+  or a running job of the same feeds.
+  """
+  def __init__(self, on_change: Callable[[JobInfo], None] | None = None):
+    self.jobs: OrderedDict[int, JobInfo] = OrderedDict()
+    self.done: dict[int, asyncio.Event] = {}
+    # extra data of active jobs used for deduplication
+    self.extra: dict[int, Any] = {}
+    self.next_id = 1
+    self.on_change = on_change
+
+  def active(self) -> list[JobInfo]:
+    return [j for j in self.jobs.values() if j.status in ("pending", "running")]
+
+  def get(self, job_id: int) -> JobInfo | None:
+    return self.jobs.get(job_id)
+
+  """
+  Submit a job to run func(job) and return the job (or the existing job it is merged into)
+  """
+  def submit(self, action: str, feed_urls: list[str] | None, options: dict, func: Callable[[JobInfo], Awaitable[None]], extra: Any = None) -> JobInfo:
+    active = self.active()
+    for j in active:
+      if j.action != action or j.options != options or self.extra[j.id] != extra:
+        continue
+      # a running job might have processed some of the feeds already
+      if (j.status == "pending" and covers(j.feed_urls, feed_urls)) or same_feeds(j.feed_urls, feed_urls):
+        return j
+
+    job = JobInfo(id=self.next_id, action=action, feed_urls=feed_urls, options=options, created_at=now_iso())
+    self.next_id += 1
+    self.jobs[job.id] = job
+    self.done[job.id] = asyncio.Event()
+    self.extra[job.id] = extra
+    blockers = [self.done[j.id] for j in active if overlap(j.feed_urls, feed_urls)]
+    self.notify(job)
+    asyncio.create_task(self.run(job, func, blockers))
+    return job
+
+  """
+  Wait for a job to finish
+  """
+  async def wait(self, job: JobInfo):
+    event = self.done.get(job.id)
+    if event:
+      await event.wait()
+
+  def notify(self, job: JobInfo):
+    if self.on_change:
+      self.on_change(job)
+
+  """
+  Update progress of a job
+  """
+  def progress(self, job: JobInfo, progress: int, total: int):
+    job.progress = progress
+    job.total = total
+    self.notify(job)
+
+  async def run(self, job: JobInfo, func: Callable[[JobInfo], Awaitable[None]], blockers: list[asyncio.Event]):
+    try:
+      for b in blockers:
+        await b.wait()
+      job.status = "running"
+      self.notify(job)
+      await func(job)
+      job.status = "done"
+    except Exception as e:
+      logging.error(f"Error occurred in job {job.id} ({job.action}): {str(e)}")
+      traceback.print_exc()
+      job.status = "failed"
+      job.error = str(e)
+    finally:
+      job.finished_at = now_iso()
+      self.extra.pop(job.id)
+      self.done.pop(job.id).set()
+      self.prune()
+      self.notify(job)
+
+  # remove oldest finished jobs
+  def prune(self):
+    finished = [j.id for j in self.jobs.values() if j.finished_at is not None]
+    for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+      del self.jobs[job_id]
@@ -0,0 +1,213 @@
+# LFReader
+# Copyright (C) 2022-2025  DCsunset
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Minimal Prometheus-style metrics (counters, gauges and histograms)
+exported in the text exposition format
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# default buckets of histograms (in seconds)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY: list["Metric"] = []
+
+def escape_label(value: str):
+  return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels: dict[str, str]):
+  if not labels:
+    return ""
+  return "{" + ",".join(f'{k}="{escape_label(str(v))}"' for k, v in labels.items()) + "}"
+
+def format_value(value: float):
+  return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+  type = ""
+
+  def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+    self.name = name
+    self.help = help
+    self.label_names = labels
+    # values by label values
+    self.values = {}
+    # metrics might be updated in db threads
+    self.lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def key(self, labels: dict[str, str]):
+    return tuple(str(labels[n]) for n in self.label_names)
+
+  def samples(self):
+    for key, value in self.values.items():
+      yield self.name, dict(zip(self.label_names, key)), value
+
+  def render(self) -> str:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+    with self.lock:
+      lines.extend(f"{name}{format_labels(labels)} {format_value(value)}" for name, labels, value in self.samples())
+    return "\n".join(lines)
+
+class Counter(Metric):
+  type = "counter"
+
+  def inc(self, amount: float = 1, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+  type = "gauge"
+
+  def set(self, value: float, **labels):
+    with self.lock:
+      self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+  type = "histogram"
+
+  def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+    super().__init__(name, help, labels)
+    self.buckets = buckets
+
+  def observe(self, value: float, **labels):
+    key = self.key(labels)
+    with self.lock:
+      # counts of each bucket (not cumulative), sum and count
+      counts, total, count = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0, 0)
+      counts[bisect_left(self.buckets, value)] += 1
+      self.values[key] = (counts, total + value, count + 1)
+
+  @contextmanager
+  def time(self, **labels):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, **labels)
+
+  def samples(self):
+    for key, (counts, total, count) in self.values.items():
+      labels = dict(zip(self.label_names, key))
+      cumulative = 0
+      for bound, c in zip((*self.buckets, "+Inf"), counts):
+        cumulative += c
+        yield f"{self.name}_bucket", {**labels, "le": bound}, cumulative
+      yield f"{self.name}_sum", labels, total
+      yield f"{self.name}_count", labels, count
+
+
+def render_metrics() -> str:
+  return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+class MetricsMiddleware:
+  """
+  ASGI middleware to record latency of API requests by route
+  (until response starts so that streaming responses are not affected)
+  """
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      return await self.app(scope, receive, send)
+
+    start = time.perf_counter()
+    async def send_wrapper(message):
+      if message["type"] == "http.response.start":
+        route = scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(
+          time.perf_counter() - start,
+          method=scope["method"],
+          route=getattr(route, "path", "unmatched"),
+          status=message["status"]
+        )
+      await send(message)
+    await self.app(scope, receive, send_wrapper)
+
+
+## Metrics
+
+HTTP_REQUEST_SECONDS = Histogram(
+  "lfreader_http_request_seconds",
+  "Latency of API requests until response starts",
+  ("method", "route", "status")
+)
+
+FEED_FETCHES = Counter(
+  "lfreader_feed_fetches_total",
+  "Number of feed fetches by result (ok, not_modified, error)",
+  ("result",)
+)
+FEED_DOWNLOAD_SECONDS = Histogram(
+  "lfreader_feed_download_seconds",
+  "Time to download feeds (including waiting for concurrency limits)"
+)
+FEED_PARSE_SECONDS = Histogram(
+  "lfreader_feed_parse_seconds",
+  "Time to parse feeds with feedparser"
+)
+FEED_LAST_FETCH_SECONDS = Gauge(
+  "lfreader_feed_last_fetch_seconds",
+  "Time to download and parse each feed in its last fetch",
+  ("feed_url",)
+)
+FEED_PROCESS_SECONDS = Histogram(
+  "lfreader_feed_process_seconds",
+  "Time to process and save entries of fetched feeds (including archiving)"
+)
+DB_UPSERT_SECONDS = Histogram(
+  "lfreader_db_upsert_seconds",
+  "Time to upsert and index entries of a feed"
+)
+DB_UPSERT_ROWS = Counter(
+  "lfreader_db_upsert_rows_total",
+  "Number of upserted entries"
+)
+
+HTML_REWRITE_SECONDS = Histogram(
+  "lfreader_html_rewrite_seconds",
+  "CPU time to parse and rewrite html for archiving (excluding downloads)",
+  ("engine",)
+)
+HTML_REWRITE_SKIPPED = Counter(
+  "lfreader_html_rewrite_skipped_total",
+  "Number of html contents without resources to archive"
+)
+RESOURCE_DOWNLOADS = Counter(
+  "lfreader_resource_downloads_total",
+  "Number of resource downloads by result (ok, error, too_large)",
+  ("result",)
+)
+RESOURCE_DOWNLOAD_SECONDS = Histogram(
+  "lfreader_resource_download_seconds",
+  "Time to download resources (including retries)"
+)
+RESOURCE_DOWNLOAD_BYTES = Counter(
+  "lfreader_resource_download_bytes_total",
+  "Number of downloaded bytes of resources"
+)
+RESOURCE_RETRIES = Counter(
+  "lfreader_resource_retries_total",
+  "Number of retries of resource downloads"
+)
@@ -15,12 +15,13 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from pydantic import BaseModel, ValidationError
-from typing import Literal
+from typing import Literal, Callable
 from datetime import datetime
 
 ### App State
 
 class AppStatus(BaseModel):
+  # whether any job is pending or running
   loading: bool
   # last updated time (ISO format)
   updated: str
@@ -28,12 +29,48 @@ class AppStatus(BaseModel):
 # App state
 class AppState:
   status: AppStatus
-  def __init__(self):
+  # called with the status when it changes
+  on_change: Callable[[AppStatus], None] | None
+
+  def __init__(self, on_change: Callable[[AppStatus], None] | None = None):
     self.status = AppStatus(loading=False, updated=datetime.now().astimezone().isoformat())
+    self.on_change = on_change
 
   # update timestamp
   def update(self):
     self.status.updated = datetime.now().astimezone().isoformat()
+    self.notify()
+
+  def set_loading(self, loading: bool):
+    if self.status.loading != loading:
+      self.status.loading = loading
+      self.notify()
+
+  def notify(self):
+    if self.on_change:
+      self.on_change(self.status)
+
+
+### Jobs API
+
+class JobInfo(BaseModel):
+  id: int
+  # action of the job (e.g. fetch or archive)
+  action: str
+  # feeds processed by the job (None for all feeds)
+  feed_urls: list[str] | None
+  # other arguments of the action
+  options: dict
+  status: Literal["pending", "running", "done", "failed"] = "pending"
+  # number of processed feeds and total number of feeds (0 if unknown)
+  progress: int = 0
+  total: int = 0
+  error: str | None = None
+  # result of the job if any (e.g. number of collected files)
+  result: dict | None = None
+  # time in ISO format
+  created_at: str
+  finished_at: str | None = None
 
 
 ### Query entries API
@@ -48,6 +85,38 @@ class QueryEntriesArgs(BaseModel):
   columns: list[str] | None = None
   offset: int = -1
   limit: int = -1
+  # opaque cursor for keyset pagination (empty string for first page)
+  # when set, offset is ignored and a page with next_cursor is returned
+  cursor: str | None = None
+
+class EntriesPage(BaseModel):
+  entries: list[dict]
+  # None if there are no more entries
+  next_cursor: str | None
+
+
+### Search entries API
+
+class SearchEntriesArgs(BaseModel):
+  # FTS5 query string
+  query: str
+  feed_urls: list[str] | None = None
+  columns: list[str] | None = None
+  offset: int = -1
+  limit: int = -1
+
+
+### Changes API
+
+class Changes(BaseModel):
+  # latest change sequence
+  seq: int
+  # inserted or updated rows
+  feeds: list[dict]
+  entries: list[dict]
+  # tombstones of deleted rows
+  deleted_feeds: list[str]
+  deleted_entries: list[QueryEntry]
 
 
 ### Feed Action API (tagged union)
@@ -90,6 +159,14 @@ class UpdateFeedsArgs(BaseModel):
   feeds: list[FeedInfo]
 
 
+### Archive Action API
+
+class CollectGarbageArgs(BaseModel):
+  action: Literal["gc"]
+  # only report orphan files without deleting them
+  dry_run: bool = False
+
+
 ### Entry Action API (tagged union)
 
 class EntryInfo(BaseModel):
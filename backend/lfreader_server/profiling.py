@@ -0,0 +1,219 @@
+# LFReader
+# Copyright (C) 2022-2025  DCsunset
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Slow query log of sqlite and opt-in profiling of API requests and background jobs
+"""
+
+import cProfile
+import io
+import logging
+import pstats
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+
+
+## Slow query log
+
+def log_slow_query(conn: sqlite3.Connection, sql: str, params, elapsed: float):
+  plan = ""
+  # params of executemany are not available
+  if params is not None:
+    try:
+      # use base cursor to avoid tracing itself
+      cur = sqlite3.Cursor(conn)
+      cur.row_factory = None
+      plan = "\n".join(f"  {r[3]}" for r in cur.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+    except sqlite3.Error as e:
+      plan = f"  (failed to explain query: {e})"
+  logging.warning(f"Slow query ({elapsed * 1000:.1f} ms): {sql.strip()}\n{plan}")
+
+class TracedCursor(sqlite3.Cursor):
+  """
+  Cursor that measures time spent in executing a statement and fetching its rows.
+  The statement is logged with its query plan once the time reaches the threshold of the connection.
+  """
+  sql = ""
+  params = None
+  elapsed = 0.0
+  logged = False
+
+  def timed(self, func, *args):
+    start = time.perf_counter()
+    try:
+      return func(*args)
+    finally:
+      self.elapsed += time.perf_counter() - start
+      if not self.logged and self.elapsed >= self.connection.slow_query_time:
+        self.logged = True
+        log_slow_query(self.connection, self.sql, self.params, self.elapsed)
+
+  def reset(self, sql: str, params):
+    self.sql = sql
+    self.params = params
+    self.elapsed = 0.0
+    self.logged = False
+
+  def execute(self, sql, params=()):
+    self.reset(sql, params)
+    return self.timed(super().execute, sql, params)
+
+  def executemany(self, sql, params):
+    self.reset(sql, None)
+    return self.timed(super().executemany, sql, params)
+
+  def fetchone(self):
+    return self.timed(super().fetchone)
+
+  def fetchmany(self, size=None):
+    return self.timed(super().fetchmany, self.arraysize if size is None else size)
+
+  def fetchall(self):
+    return self.timed(super().fetchall)
+
+  def __next__(self):
+    return self.timed(super().__next__)
+
+class TracedConnection(sqlite3.Connection):
+  """
+  Connection that logs slow statements (use as factory in sqlite3.connect)
+  """
+  # threshold of slow statements (in seconds)
+  slow_query_time = 0.0
+
+  def cursor(self, factory=TracedCursor):
+    return super().cursor(factory)
+
+  def execute(self, sql, params=()):
+    return self.cursor().execute(sql, params)
+
+  def executemany(self, sql, params):
+    return self.cursor().executemany(sql, params)
+
+
+## Profiling
+
+# profile of current request or job
+current_profile: ContextVar["Profile | None"] = ContextVar("current_profile", default=None)
+
+# the event loop thread can only be profiled by one profiler at a time
+loop_profiling = threading.Lock()
+
+def start_profiler() -> cProfile.Profile | None:
+  profiler = cProfile.Profile()
+  try:
+    profiler.enable()
+    return profiler
+  except ValueError:
+    # another profiler is active (only one is allowed at a time since Python 3.12)
+    return None
+
+class Profile:
+  """
+  Stats of a request or job collected from the event loop and db threads
+  """
+  def __init__(self, name: str):
+    self.name = name
+    self.stats: pstats.Stats | None = None
+    self.lock = threading.Lock()
+
+  def add(self, profiler: cProfile.Profile):
+    profiler.disable()
+    with self.lock:
+      if self.stats is None:
+        self.stats = pstats.Stats(profiler)
+      else:
+        self.stats.add(profiler)
+
+  # run func in current thread with profiling
+  def run(self, func, *args):
+    profiler = start_profiler()
+    try:
+      return func(*args)
+    finally:
+      if profiler:
+        self.add(profiler)
+
+  """
+  Log functions with most cumulative time and save stats to output dir (if set)
+  """
+  def report(self, output_dir: str | None, top: int):
+    if self.stats is None:
+      return
+    saved = ""
+    if output_dir:
+      path = Path(output_dir)
+      path.mkdir(parents=True, exist_ok=True)
+      filename = path.joinpath(f"{datetime.now():%Y%m%d-%H%M%S-%f}-{re.sub(r'[^A-Za-z0-9]+', '_', self.name).strip('_')}.prof")
+      self.stats.dump_stats(filename)
+      saved = f" (saved to {filename})"
+    out = io.StringIO()
+    self.stats.stream = out
+    self.stats.sort_stats("cumulative").print_stats(top)
+    logging.info(f"Profile of {self.name}{saved}:\n{out.getvalue()}")
+
+"""
+Profile code in the context on the event loop thread (including other tasks running meanwhile)
+and functions wrapped by profiled in db threads
+"""
+@contextmanager
+def profiling(name: str, output_dir: str | None, top: int):
+  profile = Profile(name)
+  token = current_profile.set(profile)
+  profiler = None
+  if loop_profiling.acquire(blocking=False):
+    profiler = start_profiler()
+    if profiler is None:
+      loop_profiling.release()
+  if profiler is None:
+    logging.warning(f"Another profiler is running, only profiling db threads for {name}")
+  try:
+    yield profile
+  finally:
+    if profiler:
+      profile.add(profiler)
+      loop_profiling.release()
+    current_profile.reset(token)
+    profile.report(output_dir, top)
+
+# wrap func to profile it in another thread if current request or job is profiled
+def profiled(func):
+  profile = current_profile.get()
+  return func if profile is None else partial(profile.run, func)
+
+class ProfilerMiddleware:
+  """
+  ASGI middleware to profile API requests with header "X-Profile: 1"
+  """
+  def __init__(self, app, output_dir: str | None = None, top: int = 30):
+    self.app = app
+    self.output_dir = output_dir
+    self.top = top
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or dict(scope["headers"]).get(b"x-profile", b"0") in (b"", b"0"):
+      return await self.app(scope, receive, send)
+
+    with profiling(f"{scope['method']} {scope['path']}", self.output_dir, self.top):
+      await self.app(scope, receive, send)
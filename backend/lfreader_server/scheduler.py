@@ -0,0 +1,89 @@
+# LFReader
+# Copyright (C) 2022-2025  DCsunset
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import random
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from .config import SchedulerConfig
+
+# number of latest entries used to estimate publish interval
+RECENT_ENTRIES = 20
+
+def publish_stats(dates: list[datetime]) -> dict[str, Any]:
+  """
+  Estimate publish cadence of a feed from the dates of its entries
+  """
+  dates = sorted(dates)[-RECENT_ENTRIES:]
+  stats = {}
+  if dates:
+    stats["last_entry_at"] = dates[-1].isoformat()
+  if len(dates) >= 2:
+    # average interval (in seconds) between recent entries
+    stats["publish_interval"] = (dates[-1] - dates[0]).total_seconds() / (len(dates) - 1)
+  return stats
+
+def next_fetch_at(server_data: dict, now: datetime, cfg: SchedulerConfig) -> str:
+  """
+  Compute next fetch time of a feed according to its publish cadence
+  """
+  interval = server_data.get("publish_interval") or 0
+  last_entry_at = server_data.get("last_entry_at")
+  if last_entry_at:
+    # back off gradually for feeds that stopped publishing
+    idle = (now - datetime.fromisoformat(last_entry_at)).total_seconds()
+    interval = max(interval, idle / 2)
+  return fetch_after(interval, now, cfg)
+
+def retry_fetch_at(failures: int, now: datetime, cfg: SchedulerConfig) -> str:
+  """
+  Compute next fetch time of a feed after consecutive failures (backing off exponentially)
+  """
+  # limit exponent to avoid overflow (capped by max_interval anyway)
+  return fetch_after(cfg.min_interval * 2 ** min(failures - 1, 32), now, cfg)
+
+def fetch_after(interval: float, now: datetime, cfg: SchedulerConfig) -> str:
+  # spread fetches of feeds with similar intervals (before bounding the interval)
+  interval *= 1 + random.uniform(-cfg.jitter, cfg.jitter)
+  interval = min(max(interval, cfg.min_interval), cfg.max_interval)
+  return datetime.fromtimestamp(now.timestamp() + interval).astimezone().isoformat()
+
+def is_due(server_data: dict, now: datetime) -> bool:
+  t = server_data.get("next_fetch_at")
+  return not t or datetime.fromisoformat(t) <= now
+
+
+class Scheduler:
+  """
+  Refresh feeds in background when they are due
+  """
+  def __init__(self, config: SchedulerConfig, get_due_feeds: Callable[[], Awaitable[list[dict]]], fetch: Callable[[list[dict]], Awaitable[None]]):
+    self.cfg = config
+    self.get_due_feeds = get_due_feeds
+    self.fetch = fetch
+
+  async def run(self):
+    while True:
+      try:
+        feeds = await self.get_due_feeds()
+        if feeds:
+          logging.info(f"Refreshing {len(feeds)} due feeds...")
+          await self.fetch(feeds)
+      except Exception as e:
+        logging.error(f"Error refreshing feeds: {e}")
+      await asyncio.sleep(self.cfg.check_interval)
@@ -18,23 +18,34 @@ import sqlite3
 import logging
 import sys
 import json
+import zlib
 from pathlib import Path
-from typing import Iterable, Any
+from typing import Iterable, Any, Callable
 from itertools import product, repeat, chain
 import feedparser
 from datetime import datetime, timezone
 from time import struct_time
+import time
 from functools import partial
+from contextlib import contextmanager
 import asyncio
 import aiohttp
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from yarl import URL
 from hashlib import blake2s
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from fastapi import HTTPException
 from urllib.request import urljoin
 
 from .archive import Archiver
 from .config import Config
-from .utils import async_map, sql_update_field
+from .utils import async_map, sql_update_field, html_to_text, HostLimiter
+from .scheduler import publish_stats, next_fetch_at, retry_fetch_at, is_due
+from .profiling import TracedConnection, profiled
+from .metrics import FEED_FETCHES, FEED_DOWNLOAD_SECONDS, FEED_PARSE_SECONDS, FEED_LAST_FETCH_SECONDS, FEED_PROCESS_SECONDS, DB_UPSERT_SECONDS, DB_UPSERT_ROWS
 from .models import QueryEntry, FeedInfo, EntryInfo
 
 # for logging
@@ -43,22 +54,56 @@ def entry_title(e):
 def feed_title(f):
   return f.get("title") or f.get("url")
 
-async def parse_feed(session: aiohttp.ClientSession, ignore_error: bool, feed: dict):
+# returned by parse_feed when feed is not modified since last fetch
+NOT_MODIFIED = object()
+
+# parse feed content (run in executor)
+def parse_content(content: bytes):
+  f = feedparser.parse(content, resolve_relative_uris=False)
+  # replace exception as it might not be picklable
+  if f.get("bozo_exception") is not None:
+    e = f["bozo_exception"]
+    f["bozo_exception"] = Exception(getattr(e, "message", str(e)))
+  return f
+
+async def parse_feed(session: aiohttp.ClientSession, limiter: HostLimiter, parse, ignore_error: bool, validators: dict[str, dict], feed: dict):
+  # conditional request using validators from last fetch
+  headers = {}
+  v = validators.get(feed["url"], {})
+  if v.get("etag"):
+    headers["If-None-Match"] = v["etag"]
+  if v.get("last_modified"):
+    headers["If-Modified-Since"] = v["last_modified"]
+
+  start = time.perf_counter()
   try:
-    # disable requoting to prevent invalid char in url
-    async with session.get(URL(feed["url"], encoded=True)) as resp:
-      return (
-        feed["url"],
-        feed["user_data"],
-        # use aiohttp to download for better error handling, headers and timeout
-        feedparser.parse(
-          await resp.read(),
-          resolve_relative_uris=False
-        )
-      )
+    async with limiter.acquire(feed["url"]):
+      # disable requoting to prevent invalid char in url
+      async with session.get(URL(feed["url"], encoded=True), headers=headers) as resp:
+        if resp.status == 304:
+          FEED_DOWNLOAD_SECONDS.observe(time.perf_counter() - start)
+          FEED_FETCHES.inc(result="not_modified")
+          return (feed["url"], feed["user_data"], NOT_MODIFIED, {})
+        content = await resp.read()
+        # only keep validators of successful responses
+        ok = resp.status == 200
+        v = {
+          "etag": resp.headers.get("ETag") if ok else None,
+          "last_modified": resp.headers.get("Last-Modified") if ok else None
+        }
+    downloaded = time.perf_counter()
+    FEED_DOWNLOAD_SECONDS.observe(downloaded - start)
+    # use aiohttp to download for better error handling, headers and timeout
+    f = await parse(content)
+    parsed = time.perf_counter()
+    FEED_PARSE_SECONDS.observe(parsed - downloaded)
+    FEED_LAST_FETCH_SECONDS.set(parsed - start, feed_url=feed["url"])
+    FEED_FETCHES.inc(result="ok")
+    return (feed["url"], feed["user_data"], f, v)
   except Exception as e:
+    FEED_FETCHES.inc(result="error")
     if ignore_error:
-      return (feed["url"], feed["user_data"], None)
+      return (feed["url"], feed["user_data"], None, {})
     else:
       raise e
 
@@ -80,29 +125,85 @@ def hash_dicts(dicts: list[dict]):
   return h.hexdigest()
 
 
-# pack data into JSON string
-def pack_data(value):
+# expression to sort entries by (must match the one in sort key indexes)
+# entries without dates are sorted last
+ENTRY_SORT_KEY = "COALESCE(published_at, updated_at, '')"
+
+# encode sort key of entry into an opaque cursor
+def encode_cursor(sort_key: str, feed_url: str, entry_id: str):
+  return urlsafe_b64encode(json.dumps([sort_key, feed_url, entry_id]).encode()).decode()
+
+def decode_cursor(cursor: str):
+  try:
+    sort_key, feed_url, entry_id = json.loads(urlsafe_b64decode(cursor.encode()))
+    return (str(sort_key), str(feed_url), str(entry_id))
+  except Exception:
+    raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+
+
+# prefix of data compressed by zlib (stored as blob)
+ZLIB_PREFIX = b"\x01"
+
+# compress string if its size reaches threshold (0 to disable compression)
+def compress_data(value: str | None, threshold: int = 0):
+  if value is None or threshold <= 0 or len(value) < threshold:
+    return value
+  return ZLIB_PREFIX + zlib.compress(value.encode())
+
+def decompress_data(value: str | bytes | None):
+  if isinstance(value, bytes) and value.startswith(ZLIB_PREFIX):
+    return zlib.decompress(value[len(ZLIB_PREFIX):]).decode()
+  return value
+
+# size in bytes of packed data (str or compressed bytes)
+def data_size(value: str | bytes | None):
+  if isinstance(value, str):
+    return len(value.encode())
+  return len(value or b"")
+
+# pack data into JSON string (compressed if compression_threshold is set)
+def pack_data(value, compression_threshold: int = 0):
   # use None for empty value (e.g. {}, [], "", None)
   if not value:
     return None
-  return json.dumps(value)
+  return compress_data(json.dumps(value), compression_threshold)
+
+# json fields with default value (in JSON)
+JSON_FIELDS = {
+  "server_data": "{}",
+  "user_data": "{}",
+  "enclosures": "[]",
+  "contents": "[]",
+  "summary": "null",
+  "categories": "[]"
+}
 
 # unpack JSON data in row
 def unpack_data(key, value):
-  # json fields with default value
-  json_fields = {
-    "server_data": {},
-    "user_data": {},
-    "enclosures": [],
-    "contents": [],
-    "summary": None,
-    "categories": []
-  }
-  if key in json_fields:
-    return json.loads(value) if value else json_fields[key]
+  if key in JSON_FIELDS:
+    return json.loads(decompress_data(value) or JSON_FIELDS[key])
   else:
     return value
 
+# convert sqlite3 row into JSON directly without unpacking JSON fields
+def row_to_json(fields: list[str], row: tuple):
+  return "{" + ",".join(map(
+    lambda kv: f"{json.dumps(kv[0])}:{(decompress_data(kv[1]) or JSON_FIELDS[kv[0]]) if kv[0] in JSON_FIELDS else json.dumps(kv[1])}",
+    zip(fields, row)
+  )) + "}"
+
+# convert packed summary or contents into plain text for search index
+def search_text(value):
+  if not value:
+    return None
+  contents = json.loads(decompress_data(value))
+  if isinstance(contents, dict):
+    contents = [contents]
+  return "\n".join(map(
+    lambda c: (c.get("value") or "") if c.get("type") == "text/plain" else html_to_text(c.get("value") or ""),
+    contents
+  ))
+
 # convert sqlite3 row into dict
 def dict_row_factory(cursor: sqlite3.Cursor, row: sqlite3.Row):
   fields = [column[0] for column in cursor.description]
@@ -113,15 +214,170 @@ class Storage:
     self.cfg = config
     # create parent directories to prevent error
     Path(config.db_file).parent.mkdir(parents=True, exist_ok=True)
-    self.db = sqlite3.connect(config.db_file)
+    # connection for writing (only used in writer thread after init)
+    self.db = self.connect(config.db_file)
+    # WAL allows reading concurrently with writing
+    self.db.execute("PRAGMA journal_mode = WAL")
     self.db.execute("PRAGMA foreign_keys = ON")
     self.db.row_factory = dict_row_factory
+    # used to build search index
+    self.db.create_function("search_text", 1, search_text, deterministic=True)
     self.init_db()
-    self.archiver = Archiver(self.db, config.archiver)
+    # single thread to serialize writes
+    self.writer = ThreadPoolExecutor(1, thread_name_prefix="db-writer")
+    # threads with read-only connections
+    self.local = threading.local()
+    self.readers = ThreadPoolExecutor(
+      config.db_readers,
+      thread_name_prefix="db-reader",
+      initializer=self.init_reader
+    )
+    # separate threads to stream results so that slow clients can't block other reads
+    self.streamers = ThreadPoolExecutor(
+      config.db_streams,
+      thread_name_prefix="db-stream",
+      initializer=self.init_reader
+    )
+    self.archiver = Archiver(self.db, config.archiver, self.write)
     self.headers = {}
     if config.user_agent is not None:
       self.headers["User-Agent"] = config.user_agent
     self.timeout = aiohttp.ClientTimeout(sock_connect=config.timeout)
+    # created lazily as they require a running event loop
+    self.connector = None
+    # limits of concurrent feed fetches shared by all fetches
+    self.limiter = None
+    self.parser = self.create_parser()
+
+  # connect to db (logging slow statements if enabled)
+  def connect(self, database: str, **kwargs) -> sqlite3.Connection:
+    if not self.cfg.debug.slow_query_ms:
+      return sqlite3.connect(database, check_same_thread=False, **kwargs)
+    db = sqlite3.connect(database, check_same_thread=False, factory=TracedConnection, **kwargs)
+    db.slow_query_time = self.cfg.debug.slow_query_ms / 1000
+    return db
+
+  def init_reader(self):
+    db = self.connect(f"{Path(self.cfg.db_file).resolve().as_uri()}?mode=ro", uri=True)
+    db.row_factory = dict_row_factory
+    self.local.db = db
+
+  # connection of current thread (read-only connection in reader threads)
+  @property
+  def conn(self) -> sqlite3.Connection:
+    return getattr(self.local, "db", self.db)
+
+  # run queries of the current thread in a read transaction to see the same snapshot of db
+  @contextmanager
+  def snapshot(self):
+    conn = self.conn
+    if conn.in_transaction:
+      yield conn
+      return
+    conn.execute("BEGIN")
+    try:
+      yield conn
+    finally:
+      conn.rollback()
+
+  # run func in writer thread (all writes must go through it)
+  # each call must commit its writes so that they are never left to other calls
+  async def write(self, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(self.writer, profiled(partial(self.transaction, func, *args)))
+
+  # roll back uncommitted writes of func if it fails (run in writer thread)
+  def transaction(self, func, *args):
+    try:
+      return func(*args)
+    except:
+      self.db.rollback()
+      raise
+
+  # run func in a reader thread (func should use self.conn to query)
+  async def read(self, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(self.readers, profiled(partial(func, *args)))
+
+  """
+  Run generator func in a stream thread and yield its items asynchronously.
+  At most buffer_size items are produced ahead of the consumer.
+  """
+  async def stream(self, func, *args, buffer_size: int = 16):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    slots = threading.Semaphore(buffer_size)
+    closed = threading.Event()
+    end = object()
+
+    def produce():
+      gen = func(*args)
+      try:
+        for item in gen:
+          slots.acquire()
+          if closed.is_set():
+            return
+          loop.call_soon_threadsafe(queue.put_nowait, item)
+        loop.call_soon_threadsafe(queue.put_nowait, end)
+      except Exception as e:
+        loop.call_soon_threadsafe(queue.put_nowait, e)
+      finally:
+        gen.close()
+
+    loop.run_in_executor(self.streamers, profiled(produce))
+    try:
+      while (item := await queue.get()) is not end:
+        if isinstance(item, Exception):
+          raise item
+        slots.release()
+        yield item
+    finally:
+      # stop producer if consumer exits early
+      closed.set()
+      slots.release(buffer_size)
+
+  def create_parser(self):
+    if self.cfg.parser_executor == "process":
+      try:
+        # use spawn as forking a multi-threaded process is unsafe
+        return ProcessPoolExecutor(self.cfg.parser_workers, mp_context=multiprocessing.get_context("spawn"))
+      except (OSError, NotImplementedError) as e:
+        logging.warning(f"Process pool unavailable, parsing feeds in threads instead: {e}")
+    return ThreadPoolExecutor(self.cfg.parser_workers)
+
+  # parse feed content in executor to avoid blocking event loop
+  async def parse_content(self, content: bytes):
+    loop = asyncio.get_running_loop()
+    try:
+      return await loop.run_in_executor(self.parser, parse_content, content)
+    except BrokenProcessPool as e:
+      logging.warning(f"Process pool broken, parsing feeds in threads instead: {e}")
+      self.parser = ThreadPoolExecutor(self.cfg.parser_workers)
+      return await loop.run_in_executor(self.parser, parse_content, content)
+
+  async def close(self):
+    if self.connector is not None:
+      await self.connector.close()
+    self.parser.shutdown(cancel_futures=True)
+    self.readers.shutdown()
+    self.streamers.shutdown()
+    self.writer.shutdown()
+
+  # create a session that reuses connections (and DNS cache) across fetches
+  def session(self):
+    if self.connector is None or self.connector.closed:
+      self.connector = aiohttp.TCPConnector(
+        limit=self.cfg.connection_limit,
+        ttl_dns_cache=self.cfg.dns_cache_ttl
+      )
+      # recreated with connector as both are bound to the event loop
+      self.limiter = HostLimiter(self.cfg.fetch_limit, self.cfg.fetch_limit_per_host)
+    # must disable requoting to prevent invalid char in url
+    return aiohttp.ClientSession(
+      headers=self.headers,
+      timeout=self.timeout,
+      requote_redirect_url=False,
+      connector=self.connector,
+      connector_owner=False
+    )
 
   def init_db(self):
     try:
@@ -143,6 +399,10 @@ class Storage:
           -- server data in JSON format
           -- - fetched_at: when this feed was last fetched
           -- - added_at: when this feed was first added to db
+          -- - etag: ETag header of last response (for conditional requests)
+          -- - last_modified: Last-Modified header of last response (for conditional requests)
+          -- - next_fetch_at: when this feed is due to refresh
+          -- - fetch_failures: number of consecutive failed fetches (to back off refreshing)
           server_data TEXT,
 
           -- user data used by client in JSON format
@@ -200,6 +460,14 @@ class Storage:
         )
       ''')
 
+      self.db.execute('''
+        -- Map resource url to its content-addressed filename
+        CREATE TABLE IF NOT EXISTS resource_files (
+          url TEXT PRIMARY KEY,  -- original resource url
+          filename TEXT NOT NULL  -- filename in resources dir
+        )
+      ''')
+
       # indexes for entries table
       self.db.execute('''
         CREATE INDEX IF NOT EXISTS entries_by_feed_url ON entries(feed_url)
@@ -210,6 +478,20 @@ class Storage:
       self.db.execute('''
         CREATE INDEX IF NOT EXISTS entries_by_updated_at ON entries(updated_at)
       ''')
+      # indexes for sorting and keyset pagination
+      self.db.execute(f'''
+        CREATE INDEX IF NOT EXISTS entries_by_sort_key ON entries({ENTRY_SORT_KEY}, feed_url, id)
+      ''')
+      self.db.execute(f'''
+        CREATE INDEX IF NOT EXISTS entries_by_feed_sort_key ON entries(feed_url, {ENTRY_SORT_KEY}, id)
+      ''')
+      # indexes for cleaning old entries of a feed
+      self.db.execute('''
+        CREATE INDEX IF NOT EXISTS entries_by_feed_published_at ON entries(feed_url, published_at)
+      ''')
+      self.db.execute('''
+        CREATE INDEX IF NOT EXISTS entries_by_feed_updated_at ON entries(feed_url, updated_at)
+      ''')
       # indexes for resources table
       self.db.execute('''
         CREATE INDEX IF NOT EXISTS resources_by_feed_url ON resources(feed_url)
@@ -220,10 +502,204 @@ class Storage:
       self.db.execute('''
         CREATE INDEX IF NOT EXISTS resources_by_url ON resources(url)
       ''')
+      # indexes for resource_files table
+      self.db.execute('''
+        CREATE INDEX IF NOT EXISTS resource_files_by_filename ON resource_files(filename)
+      ''')
+      self.init_changes()
+      self.init_search()
     except Exception as e:
       logging.critical(f"Error init db: {e}")
       sys.exit(1)
 
+  """
+  Change log of feeds and entries maintained by triggers
+  so that clients can sync incrementally
+  """
+  def init_changes(self):
+    self.db.execute('''
+      CREATE TABLE IF NOT EXISTS changes (
+        -- monotonically increasing change sequence
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        feed_url TEXT NOT NULL,
+        entry_id TEXT NOT NULL,  -- entry id or empty string to denote feed itself
+        deleted INTEGER NOT NULL  -- 1 for tombstone
+      )
+    ''')
+    # only keep the latest change of each row
+    # (triggers delete the old change before inserting a new one)
+    self.db.execute('''
+      CREATE UNIQUE INDEX IF NOT EXISTS changes_by_key ON changes(feed_url, entry_id)
+    ''')
+
+    # feeds
+    self.db.execute('''
+      CREATE TRIGGER IF NOT EXISTS feeds_insert_change AFTER INSERT ON feeds
+      BEGIN
+        DELETE FROM changes WHERE feed_url = NEW.url AND entry_id = '';
+        INSERT INTO changes(feed_url, entry_id, deleted) VALUES (NEW.url, '', 0);
+      END
+    ''')
+    self.db.execute('''
+      CREATE TRIGGER IF NOT EXISTS feeds_update_change AFTER UPDATE ON feeds
+      BEGIN
+        DELETE FROM changes WHERE feed_url = OLD.url AND entry_id = '' AND (OLD.url != NEW.url);
+        INSERT INTO changes(feed_url, entry_id, deleted)
+          SELECT OLD.url, '', 1 WHERE OLD.url != NEW.url;
+        DELETE FROM changes WHERE feed_url = NEW.url AND entry_id = '';
+        INSERT INTO changes(feed_url, entry_id, deleted) VALUES (NEW.url, '', 0);
+      END
+    ''')
+    self.db.execute('''
+      CREATE TRIGGER IF NOT EXISTS feeds_delete_change AFTER DELETE ON feeds
+      BEGIN
+        DELETE FROM changes WHERE feed_url = OLD.url AND entry_id = '';
+        INSERT INTO changes(feed_url, entry_id, deleted) VALUES (OLD.url, '', 1);
+      END
+    ''')
+
+    # entries (excluding the empty entry that denotes the feed itself)
+    self.db.execute('''
+      CREATE TRIGGER IF NOT EXISTS entries_insert_change AFTER INSERT ON entries
+        WHEN NEW.id != ''
+      BEGIN
+        DELETE FROM changes WHERE feed_url = NEW.feed_url AND entry_id = NEW.id;
+        INSERT INTO changes(feed_url, entry_id, deleted) VALUES (NEW.feed_url, NEW.id, 0);
+      END
+    ''')
+    # seq up to which tombstones have been pruned
+    self.db.execute('''
+      CREATE TABLE IF NOT EXISTS changes_pruned (seq INTEGER NOT NULL)
+    ''')
+    # rows only exist inside a transaction that rewrites entries without changing their data
+    # (e.g. re-encoding compressed columns) to skip recording changes
+    self.db.execute('''
+      CREATE TABLE IF NOT EXISTS changes_paused (paused INTEGER)
+    ''')
+    # changes of server_data alone (e.g. fetched_at) are not recorded
+    # as they happen to every entry on every fetch
+    # (recreated to update trigger of existing databases)
+    self.db.execute("DROP TRIGGER IF EXISTS entries_update_change")
+    self.db.execute('''
+      CREATE TRIGGER entries_update_change AFTER UPDATE ON entries
+        WHEN NEW.id != '' AND NOT EXISTS (SELECT 1 FROM changes_paused) AND (
+          OLD.feed_url IS NOT NEW.feed_url
+          OR OLD.id IS NOT NEW.id
+          OR OLD.link IS NOT NEW.link
+          OR OLD.author IS NOT NEW.author
+          OR OLD.title IS NOT NEW.title
+          OR OLD.categories IS NOT NEW.categories
+          OR OLD.summary IS NOT NEW.summary
+          OR OLD.contents IS NOT NEW.contents
+          OR OLD.enclosures IS NOT NEW.enclosures
+          OR OLD.published_at IS NOT NEW.published_at
+          OR OLD.updated_at IS NOT NEW.updated_at
+          OR OLD.user_data IS NOT NEW.user_data
+        )
+      BEGIN
+        DELETE FROM changes WHERE feed_url = OLD.feed_url AND entry_id = OLD.id AND (OLD.feed_url != NEW.feed_url OR OLD.id != NEW.id);
+        INSERT INTO changes(feed_url, entry_id, deleted)
+          SELECT OLD.feed_url, OLD.id, 1 WHERE OLD.feed_url != NEW.feed_url OR OLD.id != NEW.id;
+        DELETE FROM changes WHERE feed_url = NEW.feed_url AND entry_id = NEW.id;
+        INSERT INTO changes(feed_url, entry_id, deleted) VALUES (NEW.feed_url, NEW.id, 0);
+      END
+    ''')
+    self.db.execute('''
+      CREATE TRIGGER IF NOT EXISTS entries_delete_change AFTER DELETE ON entries
+        WHEN OLD.id != ''
+      BEGIN
+        DELETE FROM changes WHERE feed_url = OLD.feed_url AND entry_id = OLD.id;
+        INSERT INTO changes(feed_url, entry_id, deleted) VALUES (OLD.feed_url, OLD.id, 1);
+      END
+    ''')
+
+    # populate change log for existing databases
+    r = self.db.execute("SELECT NOT EXISTS (SELECT 1 FROM changes) AS 'empty'").fetchone()
+    if r["empty"]:
+      self.db.execute("INSERT INTO changes(feed_url, entry_id, deleted) SELECT url, '', 0 FROM feeds")
+      self.db.execute("INSERT INTO changes(feed_url, entry_id, deleted) SELECT feed_url, id, 0 FROM entries WHERE id != ''")
+    self.db.commit()
+
+  """
+  Full-text search index of entries (requires FTS5)
+  """
+  def init_search(self):
+    exists = self.db.execute(
+      "SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'entries_fts') AS 'ok'"
+    ).fetchone()["ok"]
+    try:
+      # rowid is the same as the one in entries table
+      self.db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+          title,
+          author,
+          summary,  -- plain text
+          contents,  -- plain text
+          tokenize = "unicode61 remove_diacritics 2"
+        )
+      ''')
+      self.search_enabled = True
+    except sqlite3.OperationalError as e:
+      logging.warning(f"Full-text search disabled: {e}")
+      self.search_enabled = False
+      return
+
+    # build index for existing databases
+    if not exists:
+      self.rebuild_search_index()
+
+  def rebuild_search_index(self):
+    if not self.search_enabled:
+      return
+    logging.info("Rebuilding search index...")
+    self.db.execute("DELETE FROM entries_fts")
+    self.index_entries("TRUE")
+    self.db.commit()
+
+  # (re)index entries matching condition (need to commit after calling this function)
+  def index_entries(self, condition: str, args: Iterable = ()):
+    if not self.search_enabled:
+      return
+    self.unindex_entries(condition, args)
+    self.db.execute(
+      f'''
+      INSERT INTO entries_fts(rowid, title, author, summary, contents)
+        SELECT rowid, title, author, search_text(summary), search_text(contents) FROM entries
+        WHERE id != '' AND ({condition})
+      ''',
+      args
+    )
+
+  # remove entries matching condition from index (must be called before deleting entries)
+  def unindex_entries(self, condition: str, args: Iterable = ()):
+    if not self.search_enabled:
+      return
+    self.db.execute(
+      f"DELETE FROM entries_fts WHERE rowid IN (SELECT rowid FROM entries WHERE {condition})",
+      args
+    )
+
+  # reindex entries changed after seq
+  def index_changed_entries(self, seq: int):
+    self.index_entries(
+      "(feed_url, id) IN (SELECT feed_url, entry_id FROM changes WHERE seq > ? AND deleted = 0)",
+      (seq,)
+    )
+
+  def latest_change(self) -> int:
+    # pruned tombstones may include the latest change
+    return self.conn.execute(
+      '''
+      SELECT MAX(
+        (SELECT COALESCE(MAX(seq), 0) FROM changes),
+        (SELECT COALESCE(MAX(seq), 0) FROM changes_pruned)
+      ) AS 'seq'
+      '''
+    ).fetchone()["seq"]
+
+  def pruned_change(self) -> int:
+    return self.conn.execute("SELECT COALESCE(MAX(seq), 0) AS 'seq' FROM changes_pruned").fetchone()["seq"]
+
   async def archive_content(self, session, feed_url: str, entry_id: str, content, base_url: str | None, user_data: dict):
     if content.get("type") != "text/plain":
       content["value"] = await self.archiver.archive_html(session, feed_url, entry_id, content.get("value"), base_url, user_data)
@@ -248,25 +724,294 @@ class Storage:
     return enclosures
 
 
+  # save feed data and return its user_data (run in writer thread)
+  def save_feed(self, url: str, f, f_user_data: dict | None, now: str):
+    update_feed_field = partial(sql_update_field, "feeds")
+
+    # unpacked already when converting to row dict
+    f_data = self.db.execute(
+      "SELECT server_data, user_data FROM feeds WHERE url = ?",
+      (url,)
+    ).fetchone()
+    f_server_data = f_data["server_data"] if f_data else {}
+    f_user_data = f_user_data or (f_data["user_data"] if f_data else {})
+
+    f_server_data["fetched_at"] = now
+    if "added_at" not in f_server_data:
+      f_server_data["added_at"] = now
+    f_server_data.pop("fetch_failures", None)
+    f_server_data.update(publish_stats([
+      d for d in (
+        parse_datetime(e.get("published_parsed") or e.get("updated_parsed"))
+        for e in f.entries
+      ) if d
+    ]))
+    f_server_data["next_fetch_at"] = next_fetch_at(f_server_data, datetime.fromisoformat(now), self.cfg.scheduler)
+
+    self.db.execute(
+      f'''
+      INSERT INTO feeds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET
+          {update_feed_field("link")},
+          {update_feed_field("author")},
+          {update_feed_field("title")},
+          {update_feed_field("subtitle")},
+          {update_feed_field("categories")},
+          {update_feed_field("generator")},
+          {update_feed_field("logo")},
+          {update_feed_field("published_at")},
+          {update_feed_field("updated_at")},
+          -- extra metadata
+          {update_feed_field("server_data")},
+          {update_feed_field("user_data")}
+      ''',
+      (
+        url,
+        f.feed.get("link"),
+        f.feed.get("author"),
+        f.feed.get("title"),
+        f.feed.get("subtitle"),
+        pack_data(f.feed.get("tags")),
+        f.feed.get("generator"),
+        f.feed.get("logo"),
+        datetime_to_iso(parse_datetime(f.feed.get("published_parsed"))),
+        datetime_to_iso(parse_datetime(f.feed.get("updated_parsed"))),
+        pack_data(f_server_data),
+        pack_data(f_user_data)
+      )
+    )
+    # add empty entry to denote the feed itself for resources foreign key
+    self.db.execute("INSERT OR IGNORE INTO entries(feed_url, id) VALUES (?, ?)", (url, ""))
+    # commit so that failure of other feeds won't roll it back
+    self.db.commit()
+    return f_user_data
+
+  # update feed not modified since last fetch (run in writer thread)
+  def save_feed_not_modified(self, url: str, f_server_data: dict, f_user_data: dict | None, now: str):
+    f_server_data["fetched_at"] = now
+    f_server_data.pop("fetch_failures", None)
+    f_server_data["next_fetch_at"] = next_fetch_at(f_server_data, datetime.fromisoformat(now), self.cfg.scheduler)
+    self.db.execute(
+      "UPDATE feeds SET server_data = ?, user_data = COALESCE(?, user_data) WHERE url = ?",
+      (pack_data(f_server_data), pack_data(f_user_data), url)
+    )
+    self.db.commit()
+
+  # return server_data of existing entries in the feed document to avoid querying every entry
+  # (entries and their resources are inserted together by save_entries)
+  def get_entries_server_data(self, url: str, entry_ids: list[str]) -> dict[str, dict]:
+    # unpacked already when converting to row dict
+    return {
+      r["id"]: r["server_data"]
+      for r in self.conn.execute(
+        "SELECT id, server_data FROM entries WHERE feed_url = ? AND id IN (SELECT value FROM json_each(?))",
+        (url, json.dumps(entry_ids))
+      )
+    }
+
+  # postpone next fetch of a feed that failed to fetch (run in writer thread)
+  def save_feed_failed(self, url: str, now: str):
+    f = self.db.execute("SELECT server_data FROM feeds WHERE url = ?", (url,)).fetchone()
+    if f is None:
+      return
+    # unpacked already when converting to row dict
+    f_server_data = f["server_data"]
+    failures = f_server_data.get("fetch_failures", 0) + 1
+    f_server_data["fetch_failures"] = failures
+    f_server_data["next_fetch_at"] = retry_fetch_at(failures, datetime.fromisoformat(now), self.cfg.scheduler)
+    self.db.execute(
+      "UPDATE feeds SET server_data = ? WHERE url = ?",
+      (pack_data(f_server_data), url)
+    )
+    self.db.commit()
+
+  # save entries of a feed and validators of its response and commit (run in writer thread)
+  def save_entries(self, seq: int, rows: list[tuple], url: str | None = None, f_validators: dict | None = None):
+    update_entry_field = partial(sql_update_field, "entries")
+    self.db.executemany(
+      f'''
+      INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(feed_url, id) DO UPDATE SET
+          {update_entry_field("link")},
+          {update_entry_field("author")},
+          {update_entry_field("title")},
+          {update_entry_field("categories")},
+          {update_entry_field("summary")},
+          {update_entry_field("contents")},
+          {update_entry_field("enclosures")},
+          {update_entry_field("published_at")},
+          {update_entry_field("updated_at")},
+          -- extra metadata
+          {update_entry_field("server_data")}
+      ''',
+      rows
+    )
+    if f_validators:
+      # validators set to None are removed
+      self.db.execute(
+        "UPDATE feeds SET server_data = json_patch(COALESCE(server_data, '{}'), ?) WHERE url = ?",
+        (json.dumps(f_validators), url)
+      )
+    if url is not None:
+      # resources archived for entries of the feed
+      self.archiver.save_resources(url)
+    self.index_changed_entries(seq)
+    # insert will create a tx. Must commit to save data
+    # Commit tx for every feed
+    self.db.commit()
+
+  """
+  Save a fetched feed and its entries (archiving resources if enabled).
+  Validators of the response are only saved with the entries
+  so that the feed is not treated as unmodified if processing fails.
+  """
+  async def process_feed(self, session, url: str, f, f_user_data: dict | None, f_validators: dict, now: str, archive: bool, force_archive: bool):
+    logging.info(f"Processing feed {feed_title(f) or url}...")
+    process_start = time.perf_counter()
+    seq = await self.write(self.latest_change)
+    f_user_data = await self.write(self.save_feed, url, f, f_user_data, now)
+    logo = f.feed.get("logo")
+
+    if archive and logo:
+      # empty str for entry_id to denote the feed itself
+      logo = (await self.archiver.archive_resource(session, url, "", logo, f.feed.get("link", url), f_user_data)) or logo
+
+    after_date_raw = f_user_data.get("after_date")
+    after_date = None
+    if after_date_raw:
+      try:
+        after_date = datetime.fromisoformat(after_date_raw).astimezone()
+      except:
+        raise HTTPException(status_code=400, detail=f"Invalid after_date: {after_date_raw}")
+
+    new_entries = []
+    for e in f.entries:
+      e_published = parse_datetime(e.get("published_parsed"))
+      e_updated = parse_datetime(e.get("updated_parsed"))
+
+      if after_date:
+        # skip old entries
+        if (e_published and e_published < after_date) or (e_updated and e_updated < after_date):
+          continue
+      new_entries.append((e, e_published, e_updated))
+
+    e_server_data_map = await self.read(
+      self.get_entries_server_data,
+      url,
+      [e.get("id", e.get("link")) for e, _, _ in new_entries]
+    )
+
+    rows = []
+    for e, e_published, e_updated in new_entries:
+      e_id = e.get("id", e.get("link"))
+      e_title = e.get("title", e_id)
+      logging.debug(f'Processing entry {e_title}...')
+
+      e_server_data = e_server_data_map.get(e_id) or {}
+      e_server_data["fetched_at"] = now
+      if "added_at" not in e_server_data:
+        e_server_data["added_at"] = now
+      # in case of duplicate entries in the same feed
+      e_server_data_map[e_id] = e_server_data
+
+      # base url for feed resources
+      base_url = urljoin(f.feed.get("link", url), e.get("link"))
+      summary = e.get("summary_detail")
+      contents = e.get("content")
+      enclosures = e.get("enclosures")
+      summary_hash = hash_dicts([summary]) if summary else None
+      contents_hash = hash_dicts(contents) if contents else None
+      enclosures_hash = hash_dicts(enclosures) if enclosures else None
+      if archive:
+        if summary and (summary_hash != e_server_data.get("summary_hash")
+                        or force_archive):
+          logging.info(f'Archiving summary of entry {e_title}...')
+          summary = await self.archive_content(session, url, e_id, summary, base_url, f_user_data)
+          e_server_data["summary_hash"] = summary_hash
+        else:
+          # don't update
+          summary = None
+        if contents and (contents_hash != e_server_data.get("contents_hash")
+                         or force_archive):
+          logging.info(f'Archiving contents of entry {e_title}...')
+          contents = await self.archive_contents(session, url, e_id, contents, base_url, f_user_data)
+          e_server_data["contents_hash"] = contents_hash
+        else:
+          contents = None
+        if enclosures and (enclosures_hash != e_server_data.get("enclosures_hash")
+                         or force_archive):
+          logging.info(f'Archiving enclosures of entry {e_title}...')
+          enclosures = await self.archive_enclosures(session, url, e_id, enclosures, base_url, f_user_data)
+          e_server_data["enclosures_hash"] = enclosures_hash
+        else:
+          enclosures = None
+
+      rows.append((
+        url,
+        e_id,
+        e.get("link"),
+        e.get("author"),
+        e.get("title"),
+        pack_data(e.get("tags")),
+        pack_data(summary, self.cfg.compression_threshold),
+        pack_data(contents, self.cfg.compression_threshold),
+        pack_data(enclosures),
+        datetime_to_iso(e_published),
+        datetime_to_iso(e_updated),
+        pack_data(e_server_data),
+        None
+      ))
+
+    start_time = time.perf_counter()
+    await self.write(self.save_entries, seq, rows, url, f_validators)
+    duration = time.perf_counter() - start_time
+    DB_UPSERT_SECONDS.observe(duration)
+    DB_UPSERT_ROWS.inc(len(rows))
+    FEED_PROCESS_SECONDS.observe(time.perf_counter() - process_start)
+    logging.info(f"Saved {len(rows)} entries of feed {feed_title(f.feed) or url} in {duration:.3f}s ({len(rows) / max(duration, 1e-6):.0f} rows/s)")
+
   """
-  Fetch feeds.
-  If feeds is None, fetch all feeds
+  Fetch feeds and save their user data.
+  If feeds is None, fetch feeds of feed_urls (all feeds if it's None as well) without saving user data
+  so that updates of user data during the fetch are kept.
   """
-  async def fetch_feeds(self, feeds: list[FeedInfo], archive: bool, force_archive: bool, ignore_error: bool):
-    # must disable requoting to prevent invalid char in url
-    async with aiohttp.ClientSession(headers=self.headers, timeout=self.timeout, requote_redirect_url=False) as session:
-      feeds = feeds or self.get_feeds(columns=["url", "title", "user_data"])
-      feeds = filter(lambda f: not f["user_data"].get("frozen"), feeds)
+  # progress(done, total) is called after processing each feed if specified
+  async def fetch_feeds(self, feeds: list[FeedInfo] | None, archive: bool, force_archive: bool, ignore_error: bool, progress: Callable[[int, int], None] | None = None, feed_urls: list[str] | None = None):
+    save_user_data = feeds is not None
+    if archive:
+      await asyncio.to_thread(self.archiver.refresh_index)
+    async with self.session() as session:
+      if feeds is None:
+        feeds = await self.read(self.get_feeds, feed_urls, ["url", "title", "user_data"])
+      feeds = list(filter(lambda f: not f["user_data"].get("frozen"), feeds))
+      if progress:
+        progress(0, len(feeds))
 
-      feeds = await asyncio.gather(*map(partial(parse_feed, session, ignore_error), feeds))
+      # validators (etag and last_modified) for conditional requests
+      # (disabled when force archiving as entries need to be processed again)
+      validators = {} if force_archive else {
+        f["url"]: f["server_data"]
+        for f in await self.read(self.get_feeds, [f["url"] for f in feeds], ["url", "server_data"])
+      }
+      feeds = await asyncio.gather(*map(partial(parse_feed, session, self.limiter, self.parse_content, ignore_error, validators), feeds))
       now = datetime.now().astimezone().isoformat()
-      update_feed_field = partial(sql_update_field, "feeds")
-      update_entry_field = partial(sql_update_field, "entries")
 
-      for url, f_user_data, f in feeds:
+      for i, (url, f_user_data, f, f_validators) in enumerate(feeds):
+        if progress and i > 0:
+          progress(i, len(feeds))
+        if not save_user_data:
+          # user data in db is used when saving the feed
+          f_user_data = None
+
         # Failed to fetch feeds
         if f is None:
           logging.warning(f"Error fetching feed {url}")
+          await self.write(self.save_feed_failed, url, now)
+          continue
+
+        if f is NOT_MODIFIED:
+          logging.info(f"Feed not modified: {url}")
+          await self.write(self.save_feed_not_modified, url, validators[url], f_user_data, now)
           continue
 
         if f.bozo:
@@ -275,163 +1020,14 @@ class Storage:
           msg = f"Error parsing feed {url}: {err_msg}"
           logging.warning(msg)
 
-        logging.info(f"Processing feed {feed_title(f) or url}...")
-
-        # unpacked already when converting to row dict
-        f_data = self.db.execute(
-          "SELECT server_data, user_data FROM feeds WHERE url = ?",
-          (url,)
-        ).fetchone()
-        f_server_data = f_data["server_data"] if f_data else {}
-        f_user_data = f_user_data or (f_data["user_data"] if f_data else {})
-        logo = f.feed.get("logo")
-
-        f_server_data["fetched_at"] = now
-        if "added_at" not in f_server_data:
-          f_server_data["added_at"] = now
-
-        self.db.execute(
-          f'''
-          INSERT INTO feeds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(url) DO UPDATE SET
-              {update_feed_field("link")},
-              {update_feed_field("author")},
-              {update_feed_field("title")},
-              {update_feed_field("subtitle")},
-              {update_feed_field("categories")},
-              {update_feed_field("generator")},
-              {update_feed_field("logo")},
-              {update_feed_field("published_at")},
-              {update_feed_field("updated_at")},
-              -- extra metadata
-              {update_feed_field("server_data")},
-              {update_feed_field("user_data")}
-          ''',
-          (
-            url,
-            f.feed.get("link"),
-            f.feed.get("author"),
-            f.feed.get("title"),
-            f.feed.get("subtitle"),
-            pack_data(f.feed.get("tags")),
-            f.feed.get("generator"),
-            logo,
-            datetime_to_iso(parse_datetime(f.feed.get("published_parsed"))),
-            datetime_to_iso(parse_datetime(f.feed.get("updated_parsed"))),
-            pack_data(f_server_data),
-            pack_data(f_user_data)
-          )
-        )
-        # add empty entry to denote the feed itself for resources foreign key
-        self.db.execute("INSERT OR IGNORE INTO entries(feed_url, id) VALUES (?, ?)", (url, ""))
-
-        if archive and logo:
-          # empty str for entry_id to denote the feed itself
-          logo = (await self.archiver.archive_resource(session, url, "", logo, f.feed.get("link", url), f_user_data)) or logo
+        try:
+          await self.process_feed(session, url, f, f_user_data, f_validators, now, archive, force_archive)
+        finally:
+          # resources of the failed feed are not referenced by any saved entry
+          self.archiver.discard_resources(url)
 
-        after_date_raw = f_user_data.get("after_date")
-        after_date = None
-        if after_date_raw:
-          try:
-            after_date = datetime.fromisoformat(after_date_raw).astimezone()
-          except:
-            raise HTTPException(status_code=400, detail=f"Invalid after_date: {after_date_raw}")
-
-        for e in f.entries:
-          e_published = parse_datetime(e.get("published_parsed"))
-          e_updated = parse_datetime(e.get("updated_parsed"))
-
-          if after_date:
-            # skip old entries
-            if (e_published and e_published < after_date) or (e_updated and e_updated < after_date):
-              continue
-
-          e_id = e.get("id", e.get("link"))
-          e_title = e.get("title", e_id)
-          logging.debug(f'Processing entry {e_title}...')
-
-          # unpacked already when converting to row dict
-          e_data = self.db.execute(
-            "SELECT server_data, user_data FROM entries WHERE feed_url = ? and id = ?",
-            (url, e_id)
-          ).fetchone()
-          e_server_data = e_data["server_data"] if e_data else {}
-          e_user_data = e_data["user_data"] if e_data else {}
-
-          e_server_data["fetched_at"] = now
-          if "added_at" not in e_server_data:
-            e_server_data["added_at"] = now
-
-          # must insert the entry placeholder first to pass foreign key check when archiving
-          self.db.execute("INSERT OR IGNORE INTO entries(feed_url, id) VALUES (?, ?)", (url, e_id))
-
-          # base url for feed resources
-          base_url = urljoin(f.feed.get("link", url), e.get("link"))
-          summary = e.get("summary_detail")
-          contents = e.get("content")
-          enclosures = e.get("enclosures")
-          summary_hash = hash_dicts([summary]) if summary else None
-          contents_hash = hash_dicts(contents) if contents else None
-          enclosures_hash = hash_dicts(enclosures) if enclosures else None
-          if archive:
-            if summary and (summary_hash != e_server_data.get("summary_hash")
-                            or force_archive):
-              logging.info(f'Archiving summary of entry {e_title}...')
-              summary = await self.archive_content(session, url, e_id, summary, base_url, f_user_data)
-              e_server_data["summary_hash"] = summary_hash
-            else:
-              # don't update
-              summary = None
-            if contents and (contents_hash != e_server_data.get("contents_hash")
-                             or force_archive):
-              logging.info(f'Archiving contents of entry {e_title}...')
-              contents = await self.archive_contents(session, url, e_id, contents, base_url, f_user_data)
-              e_server_data["contents_hash"] = contents_hash
-            else:
-              contents = None
-            if enclosures and (enclosures_hash != e_server_data.get("enclosures_hash")
-                             or force_archive):
-              logging.info(f'Archiving enclosures of entry {e_title}...')
-              enclosures = await self.archive_enclosures(session, url, e_id, enclosures, base_url, f_user_data)
-              e_server_data["enclosures_hash"] = enclosures_hash
-            else:
-              enclosures = None
-
-          self.db.execute(
-            f'''
-            INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-              ON CONFLICT(feed_url, id) DO UPDATE SET
-                {update_entry_field("link")},
-                {update_entry_field("author")},
-                {update_entry_field("title")},
-                {update_entry_field("categories")},
-                {update_entry_field("summary")},
-                {update_entry_field("contents")},
-                {update_entry_field("enclosures")},
-                {update_entry_field("published_at")},
-                {update_entry_field("updated_at")},
-                -- extra metadata
-                {update_entry_field("server_data")}
-            ''',
-            (
-              url,
-              e_id,
-              e.get("link"),
-              e.get("author"),
-              e.get("title"),
-              pack_data(e.get("tags")),
-              pack_data(summary),
-              pack_data(contents),
-              pack_data(enclosures),
-              datetime_to_iso(e_published),
-              datetime_to_iso(e_updated),
-              pack_data(e_server_data),
-              None
-            )
-          )
-        # insert will create a tx. Must commit to save data
-        # Commit tx for every feed
-        self.db.commit()
+      if progress:
+        progress(len(feeds), len(feeds))
 
   def get_feeds_cursor(
     self,
@@ -446,7 +1042,7 @@ class Storage:
       placeholders = ", ".join(repeat("?", len(feed_urls)))
       query += f" WHERE url IN ({placeholders})"
       args.extend(feed_urls)
-    return self.db.execute(query, args)
+    return self.conn.execute(query, args)
 
   def get_feeds(
     self,
@@ -455,15 +1051,29 @@ class Storage:
   ) -> list[dict[str, Any]]:
     return self.get_feeds_cursor(feed_urls, columns).fetchall()
 
+  """
+  Get feeds that are due to refresh (excluding frozen ones)
+  """
+  def get_due_feeds(self) -> list[dict[str, Any]]:
+    now = datetime.now().astimezone()
+    return [
+      f for f in self.get_feeds(None, ["url", "user_data", "server_data"])
+      if not f["user_data"].get("frozen") and is_due(f["server_data"], now)
+    ]
+
   def get_entries_cursor(
     self,
     feed_urls: list[str] | None = None,
     entries: list[QueryEntry] | None = None,
     offset: int = -1,
     limit: int = -1,
-    columns: list[str] | None = None
+    columns: list[str] | None = None,
+    cursor: str | None = None
   ) -> list[dict]:
     cols = ", ".join(columns) if columns else "*"
+    if cursor is not None:
+      # sort key is needed to compute next cursor
+      cols += f", {ENTRY_SORT_KEY} AS sort_key"
     query = f"SELECT {cols} FROM entries WHERE id != ''"
     args = []
     if feed_urls is not None:
@@ -473,19 +1083,29 @@ class Storage:
       args.extend(feed_urls)
     if entries is not None:
       if len(entries) == 0:
-        return []
-      if feed_urls is not None:
-        raise HTTPException(status_code=400, detail=f"Invalid query with both feed_urls and entries set")
-      # use placeholder to prevent SQL injection
-      placeholders = " OR ".join(repeat("(feed_url = ? AND id = ?)", len(entries)))
-      query += f" AND ({placeholders})"
-      args.extend(chain(*map(lambda e: [e.feed_url, e.id], entries)))
+        # match nothing
+        query += " AND 0"
+      else:
+        if feed_urls is not None:
+          raise HTTPException(status_code=400, detail=f"Invalid query with both feed_urls and entries set")
+        # use placeholder to prevent SQL injection
+        placeholders = " OR ".join(repeat("(feed_url = ? AND id = ?)", len(entries)))
+        query += f" AND ({placeholders})"
+        args.extend(chain(*map(lambda e: [e.feed_url, e.id], entries)))
+
+    if cursor:
+      # seek to entries after cursor
+      # (the redundant sort key condition allows a range search on the sort key index)
+      sort_key, feed_url, entry_id = decode_cursor(cursor)
+      query += f" AND {ENTRY_SORT_KEY} <= ? AND ({ENTRY_SORT_KEY}, feed_url, id) < (?, ?, ?)"
+      args.extend((sort_key, sort_key, feed_url, entry_id))
 
     # -1 means no limit or offset
-    query += " ORDER BY COALESCE(published_at, updated_at) DESC LIMIT ? OFFSET ?"
+    # feed_url and id make the order stable for keyset pagination
+    query += f" ORDER BY {ENTRY_SORT_KEY} DESC, feed_url DESC, id DESC LIMIT ? OFFSET ?"
     args.extend((limit, offset))
 
-    return self.db.execute(query, args)
+    return self.conn.execute(query, args)
 
   def get_entries(
     self,
@@ -497,6 +1117,142 @@ class Storage:
   ) -> list[dict]:
     return self.get_entries_cursor(feed_urls, entries, offset, limit, columns).fetchall()
 
+  """
+  Get entries as chunks of JSON array (to be used with self.stream)
+  """
+  def get_entries_json(
+    self,
+    feed_urls: list[str] | None = None,
+    entries: list[QueryEntry] | None = None,
+    offset: int = -1,
+    limit: int = -1,
+    columns: list[str] | None = None,
+    batch_size: int = 500
+  ):
+    cursor = self.get_entries_cursor(feed_urls, entries, offset, limit, columns)
+    # use raw values to avoid unpacking JSON fields
+    cursor.row_factory = None
+    fields = [column[0] for column in cursor.description]
+    sep = "["
+    while rows := cursor.fetchmany(batch_size):
+      yield sep + ",".join(map(partial(row_to_json, fields), rows))
+      sep = ","
+    yield "[]" if sep == "[" else "]"
+
+  """
+  Get a page of entries after cursor (empty string for first page)
+  and the cursor of next page (None if no more entries)
+  """
+  def get_entries_page(
+    self,
+    feed_urls: list[str] | None = None,
+    entries: list[QueryEntry] | None = None,
+    cursor: str = "",
+    limit: int = -1,
+    columns: list[str] | None = None
+  ) -> dict[str, Any]:
+    # feed_url and id are needed to compute next cursor
+    if columns:
+      columns = list(dict.fromkeys(["feed_url", "id", *columns]))
+    rows = list(self.get_entries_cursor(feed_urls, entries, -1, limit, columns, cursor))
+    next_cursor = None
+    if limit > 0 and len(rows) == limit:
+      last = rows[-1]
+      next_cursor = encode_cursor(last["sort_key"], last["feed_url"], last["id"])
+    for r in rows:
+      del r["sort_key"]
+    return {
+      "entries": rows,
+      "next_cursor": next_cursor
+    }
+
+  """
+  Full-text search entries ranked by relevance
+  """
+  def search_entries(
+    self,
+    query: str,
+    feed_urls: list[str] | None = None,
+    offset: int = -1,
+    limit: int = -1,
+    columns: list[str] | None = None
+  ) -> list[dict]:
+    if not self.search_enabled:
+      raise HTTPException(status_code=501, detail="Full-text search not supported by SQLite")
+    cols = ", ".join(map(lambda c: f"entries.{c}", columns)) if columns else "entries.*"
+    sql = f'''
+      SELECT {cols} FROM entries_fts
+        INNER JOIN entries ON entries.rowid = entries_fts.rowid
+        WHERE entries_fts MATCH ?
+    '''
+    args = [query]
+    if feed_urls is not None:
+      # use placeholder to prevent SQL injection
+      placeholders = ", ".join(repeat("?", len(feed_urls)))
+      sql += f" AND entries.feed_url IN ({placeholders})"
+      args.extend(feed_urls)
+    # weights of columns: title, author, summary, contents
+    # -1 means no limit or offset
+    sql += " ORDER BY bm25(entries_fts, 10.0, 5.0, 2.0, 1.0) LIMIT ? OFFSET ?"
+    args.extend((limit, offset))
+    try:
+      return self.conn.execute(sql, args).fetchall()
+    except sqlite3.OperationalError as e:
+      raise HTTPException(status_code=400, detail=f"Invalid search query: {e}")
+
+  """
+  Get feeds and entries changed after seq and tombstones of deleted ones
+  (no tombstones for a full sync with since = 0)
+  """
+  def get_changes(
+    self,
+    since: int = 0,
+    columns: list[str] | None = None
+  ) -> dict[str, Any]:
+    # read seq and rows in the same transaction so that seq matches the data
+    with self.snapshot() as conn:
+      if 0 < since < self.pruned_change():
+        raise HTTPException(status_code=410, detail="Deleted changes have been pruned. Sync again with since = 0")
+      seq = self.latest_change()
+      feeds = conn.execute(
+        '''
+        SELECT feeds.* FROM changes
+          INNER JOIN feeds ON feeds.url = changes.feed_url
+          WHERE changes.seq > ? AND changes.entry_id = '' AND changes.deleted = 0
+        ''',
+        (since,)
+      ).fetchall()
+      cols = ", ".join(map(lambda c: f"entries.{c}", columns)) if columns else "entries.*"
+      entries = conn.execute(
+        f'''
+        SELECT {cols} FROM changes
+          INNER JOIN entries ON entries.feed_url = changes.feed_url AND entries.id = changes.entry_id
+          WHERE changes.seq > ? AND changes.entry_id != '' AND changes.deleted = 0
+          ORDER BY COALESCE(entries.published_at, entries.updated_at) DESC
+        ''',
+        (since,)
+      ).fetchall()
+      deleted_feeds = []
+      deleted_entries = []
+      # a client without local data has nothing to delete
+      tombstones = conn.execute(
+        "SELECT feed_url, entry_id FROM changes WHERE seq > ? AND deleted = 1",
+        (since,)
+      ).fetchall() if since > 0 else []
+      for r in tombstones:
+        if r["entry_id"]:
+          deleted_entries.append({"feed_url": r["feed_url"], "id": r["entry_id"]})
+        else:
+          deleted_feeds.append(r["feed_url"])
+
+    return {
+      "seq": seq,
+      "feeds": feeds,
+      "entries": entries,
+      "deleted_feeds": deleted_feeds,
+      "deleted_entries": deleted_entries
+    }
+
   def update_entries(self, entries: list[EntryInfo]):
     cur = self.db.cursor()
     for e in entries:
@@ -524,18 +1280,22 @@ class Storage:
     placeholders = ", ".join(repeat("?", len(feed_urls)))
 
     # delete archived resources
-    for f in feed_urls:
-      self.archiver.delete_resources(f)
+    self.archiver.delete_resources_where(f"feed_url IN ({placeholders})", feed_urls)
+    self.archiver.delete_unreferenced_files()
 
+    self.unindex_entries(f"feed_url IN ({placeholders})", feed_urls)
     # delete associated entries first to avoid violating foreign key constraints
     self.db.execute(f"DELETE FROM entries WHERE feed_url IN ({placeholders})", feed_urls)
     self.db.execute(f"DELETE FROM feeds WHERE url IN ({placeholders})", feed_urls)
     # delete will create a tx. Must commit to save data
     self.db.commit()
 
-  # clean old entries before after_date
-  def clean_feeds(self, feed_urls: list[str] | None):
-    feeds = self.get_feeds_cursor(feed_urls=feed_urls, columns=["url", "title", "user_data"])
+  """
+  Clean old entries before after_date of feeds.
+  Entries are deleted in batches and archived files no longer referenced are deleted at last.
+  """
+  def clean_feeds(self, feed_urls: list[str] | None, batch_size: int = 500):
+    feeds = self.get_feeds_cursor(feed_urls=feed_urls, columns=["url", "title", "user_data"]).fetchall()
     for f in feeds:
       f_url = f["url"]
       after_date_raw = f["user_data"].get("after_date")
@@ -549,37 +1309,142 @@ class Storage:
         raise HTTPException(status_code=400, detail=f"Invalid after_date for feed: {feed_title(f)}: {after_date_raw}")
 
       logging.info(f"Cleaning feed: {feed_title(f)}...")
-      for e in self.get_entries_cursor([f["url"]]):
-        e_id = e["id"]
-        e_published = e["published_at"] and datetime.fromisoformat(e["published_at"])
-        e_updated = e["updated_at"] and datetime.fromisoformat(e["updated_at"])
-        if (e_published and e_published < after_date) or (e_updated and e_updated < after_date):
-          logging.info(f"Removing old entry: {entry_title(e)}...")
-          self.archiver.delete_resources(f_url, e_id)
-          self.db.execute("DELETE FROM entries WHERE feed_url = ? AND id = ?", (f_url, e_id))
+      # dates of entries are stored in ISO format in UTC so they can be compared as strings
+      after = after_date.astimezone(timezone.utc).isoformat()
+      deleted = 0
+      while True:
+        rowids = [
+          r["rowid"]
+          for r in self.db.execute(
+            "SELECT rowid FROM entries WHERE feed_url = ? AND (published_at < ? OR updated_at < ?) LIMIT ?",
+            (f_url, after, after, batch_size)
+          )
+        ]
+        if not rowids:
+          break
+        condition = f"rowid IN ({', '.join(repeat('?', len(rowids)))})"
+        self.archiver.delete_resources_where(
+          f"feed_url = ? AND entry_id IN (SELECT id FROM entries WHERE {condition})",
+          [f_url, *rowids]
+        )
+        self.unindex_entries(condition, rowids)
+        self.db.execute(f"DELETE FROM entries WHERE {condition}", rowids)
+        self.db.commit()
+        deleted += len(rowids)
+      logging.info(f"Removed {deleted} old entries of feed {feed_title(f)}")
+
+    self.archiver.delete_unreferenced_files()
+    self.db.commit()
+
+  """
+  Delete tombstones in change log up to before_seq (all by default).
+  Clients that last synced before it have to sync again from scratch.
+  Return number of deleted tombstones.
+  """
+  def prune_changes(self, before_seq: int | None = None) -> int:
+    if before_seq is None:
+      before_seq = self.latest_change()
+    before_seq = max(before_seq, self.pruned_change())
+    count = self.db.execute("DELETE FROM changes WHERE deleted = 1 AND seq <= ?", (before_seq,)).rowcount
+    self.db.execute("DELETE FROM changes_pruned")
+    self.db.execute("INSERT INTO changes_pruned VALUES (?)", (before_seq,))
+    self.db.commit()
+    return count
+
+  """
+  Compress or decompress summary and contents of existing entries according to compression_threshold.
+  Entries are updated in small batches so that it can run while server is running.
+  Return sizes of the columns before and after.
+  """
+  def compress_entries(self, batch_size: int = 500):
+    threshold = self.cfg.compression_threshold
+    size_before = 0
+    size_after = 0
+    last_rowid = 0
+    while True:
+      cursor = self.db.execute(
+        "SELECT rowid, summary, contents FROM entries WHERE rowid > ? ORDER BY rowid LIMIT ?",
+        (last_rowid, batch_size)
+      )
+      # use raw values to compare with packed ones
+      cursor.row_factory = None
+      rows = cursor.fetchall()
+      if not rows:
+        break
+      updates = []
+      for rowid, summary, contents in rows:
+        new_summary = compress_data(decompress_data(summary), threshold)
+        new_contents = compress_data(decompress_data(contents), threshold)
+        size_before += data_size(summary) + data_size(contents)
+        size_after += data_size(new_summary) + data_size(new_contents)
+        if new_summary != summary or new_contents != contents:
+          updates.append((new_summary, new_contents, rowid))
+      # re-encoding doesn't change data of entries
+      self.db.execute("INSERT INTO changes_paused VALUES (1)")
+      try:
+        self.db.executemany("UPDATE entries SET summary = ?, contents = ? WHERE rowid = ?", updates)
+      finally:
+        self.db.execute("DELETE FROM changes_paused")
       self.db.commit()
+      last_rowid = rows[-1][0]
+      logging.info(f"Processed entries up to rowid {last_rowid} ({len(updates)} updated)")
+    return size_before, size_after
+
+  # update archived entry with its resources and commit (run in writer thread)
+  def save_archived_entry(self, url: str, e_id: str, summary, contents, enclosures):
+    self.db.execute(
+      f'''
+      UPDATE entries
+      SET summary = ?, contents = ?, enclosures = ?
+      WHERE feed_url = ? AND id = ?
+      ''',
+      (
+        pack_data(summary, self.cfg.compression_threshold),
+        pack_data(contents, self.cfg.compression_threshold),
+        pack_data(enclosures),
+        url,
+        e_id
+      )
+    )
+    self.archiver.save_resources(url)
+    self.index_entries("feed_url = ? AND id = ?", (url, e_id))
+    # commit every entry so that finished work is kept if archiving fails later
+    self.db.commit()
+
+  def get_archive_data(self, url: str):
+    f = self.conn.execute(
+      "SELECT link, user_data FROM feeds WHERE url = ?",
+      (url,)
+    ).fetchone()
+    entries = self.conn.execute(
+      "SELECT id, title, link, summary, contents, enclosures FROM entries WHERE feed_url = ?",
+      (url,)
+    ).fetchall()
+    return f, entries
 
   # archive feeds in database
-  async def archive_feeds(self, feed_urls: Iterable[str] | None = None):
-    urls = feed_urls or map(lambda v: v["url"], self.get_feeds(columns=["url"]))
+  # progress(done, total) is called after archiving each feed if specified
+  async def archive_feeds(self, feed_urls: Iterable[str] | None = None, progress: Callable[[int, int], None] | None = None):
+    if feed_urls is None:
+      feed_urls = map(lambda v: v["url"], await self.read(self.get_feeds, None, ["url"]))
+    urls = list(feed_urls)
 
-    # must disable requoting to prevent invalid char in url
-    async with aiohttp.ClientSession(headers=self.headers, timeout=self.timeout, requote_redirect_url=False) as session:
-      for url in urls:
-        for f in self.db.execute(
-          "SELECT link, user_data FROM feeds WHERE url = ?",
-          (url,)
-        ):
-          f_user_data = f["user_data"] or {}
-          for e in self.db.execute(
-            "SELECT id, title, link, summary, contents, enclosures FROM entries WHERE feed_url = ?",
-            (url,)
-          ):
-            base_url = urljoin(f["link"] or url, e["link"])
-            e_id = e["id"]
-            summary = e["summary"]
-            contents = e["contents"]
-            enclosures = e["enclosures"]
+    await asyncio.to_thread(self.archiver.refresh_index)
+    async with self.session() as session:
+      for i, url in enumerate(urls):
+        if progress:
+          progress(i, len(urls))
+        f, entries = await self.read(self.get_archive_data, url)
+        if f is None:
+          continue
+        f_user_data = f["user_data"] or {}
+        for e in entries:
+          base_url = urljoin(f["link"] or url, e["link"])
+          e_id = e["id"]
+          summary = e["summary"]
+          contents = e["contents"]
+          enclosures = e["enclosures"]
+          try:
             if summary:
               logging.info(f'Archiving summary of entry {entry_title(e)}...')
               summary = await self.archive_content(session, url, e_id, summary, base_url, f_user_data)
@@ -590,18 +1455,8 @@ class Storage:
               logging.info(f'Archiving enclosures of entry {entry_title(e)}...')
               enclosures = await self.archive_enclosures(session, url, e_id, enclosures, base_url, f_user_data)
 
-            self.db.execute(
-              f'''
-              UPDATE entries
-              SET summary = ?, contents = ?, enclosures = ?
-              WHERE feed_url = ? AND id = ?
-              ''',
-              (
-                pack_data(summary),
-                pack_data(contents),
-                pack_data(enclosures),
-                url,
-                e_id
-              )
-            )
-        self.db.commit()
+            await self.write(self.save_archived_entry, url, e_id, summary, contents, enclosures)
+          finally:
+            self.archiver.discard_resources(url)
+      if progress:
+        progress(len(urls), len(urls))
@@ -1,4 +1,9 @@
 import asyncio
+import re
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from yarl import URL
+from html import unescape
 
 # interval only applied when sequential is true
 async def async_map(func, iter, sequential, interval=0):
@@ -15,3 +20,34 @@ async def async_map(func, iter, sequential, interval=0):
 # SQL query that updates field by coalescing with old fields
 def sql_update_field(table: str, field: str):
   return f"{field} = COALESCE(excluded.{field}, {table}.{field})"
+
+# strip tags from html to get plain text (e.g. for search index)
+def html_to_text(html: str):
+  html = re.sub(r"<(script|style)\b.*?</\1\s*>", " ", html, flags=re.S | re.I)
+  return unescape(re.sub(r"<[^>]*>", " ", html))
+
+class HostLimiter:
+  """
+  Limit number of concurrent tasks globally and per host (0 for no limit)
+  """
+  def __init__(self, limit: int, limit_per_host: int):
+    self.limit = asyncio.Semaphore(limit) if limit > 0 else None
+    self.host_limits = defaultdict(lambda: asyncio.Semaphore(limit_per_host)) if limit_per_host > 0 else None
+
+  @asynccontextmanager
+  async def acquire(self, url: str):
+    # acquire host limit first to avoid occupying global slots while waiting for a busy host
+    host_limit = self.host_limits[URL(url, encoded=True).host] if self.host_limits is not None else None
+    if host_limit:
+      await host_limit.acquire()
+    try:
+      if self.limit:
+        await self.limit.acquire()
+      try:
+        yield
+      finally:
+        if self.limit:
+          self.limit.release()
+    finally:
+      if host_limit:
+        host_limit.release()
@@ -16,7 +16,7 @@
 
 import { Router, Route } from "@solidjs/router"
 import Layout from './components/Layout'
-import { checkUpdate } from "./state/actions"
+import { checkUpdate, eventsConnected, subscribeEvents } from "./state/actions"
 import { createEffect, onMount, onCleanup } from "solid-js"
 import { state } from "./state/store"
 
@@ -24,16 +24,19 @@ function App() {
   // Fetch status and data on init
   onMount(checkUpdate)
 
+  // Get updates from server events
+  onMount(() => onCleanup(subscribeEvents()))
+
   createEffect(() => {
     const theme = state.settings.dark ? "dark" : "light"
     document.documentElement.setAttribute("data-theme", theme)
   })
 
   createEffect(() => {
-    // Periodically fetch updates
+    // Periodically fetch updates if server events are not available
     let interval = state.settings.reloadInterval
     if (interval > 0) {
-      let id = setInterval(checkUpdate, interval * 1000)
+      let id = setInterval(() => eventsConnected() || checkUpdate(), interval * 1000)
       onCleanup(() => clearInterval(id))
     }
   })
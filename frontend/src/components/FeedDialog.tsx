@@ -98,6 +98,7 @@ export default function FeedDialog() {
   let playbackRateRef!: HTMLInputElement
   let archiveBlacklistRef!: HTMLInputElement
   let archiveIntervalRef!: HTMLInputElement
+  let maxResourceSizeRef!: HTMLInputElement
   let freezeFeedRef!: HTMLInputElement
 
   // reactive values
@@ -120,6 +121,7 @@ export default function FeedDialog() {
     if (!f) return
 
     const archiveInterval = archiveIntervalRef.value
+    const maxResourceSize = maxResourceSizeRef.value
     const t = tags()
 
     const userData: FeedUserData = {
@@ -132,6 +134,7 @@ export default function FeedDialog() {
       archive_blacklist: archiveBlacklistRef.value || undefined,
       archive_sequential: archiveSequential() || undefined,
       archive_interval: (archiveInterval && parseFloat(archiveIntervalRef.value)) || undefined,
+      max_resource_size: (maxResourceSize && Math.round(parseFloat(maxResourceSize) * 1024 * 1024)) || undefined,
       frozen: freezeFeedRef.checked || undefined,
     }
 
@@ -162,6 +165,7 @@ export default function FeedDialog() {
       archiveBlacklistRef.value = d.archive_blacklist ?? ""
       setArchiveSequential(d.archive_sequential ?? false)
       archiveIntervalRef.value = d.archive_interval?.toString() ?? ""
+      maxResourceSizeRef.value = d.max_resource_size ? (d.max_resource_size / 1024 / 1024).toString() : ""
       freezeFeedRef.checked = d.frozen ?? false
     })
   }
@@ -399,6 +403,18 @@ export default function FeedDialog() {
             />
           </SettingsItem>
 
+          <SettingsItem
+            title="Max Resource Size"
+            subtitle="skip archiving larger resources (in MiB)"
+          >
+            <input
+              ref={maxResourceSizeRef}
+              class="d-input"
+              type="text"
+              placeholder="(default)"
+            />
+          </SettingsItem>
+
           <SettingsItem
             title="Freeze Feed"
             subtitle="no longer update the feed from source"
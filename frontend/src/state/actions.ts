@@ -15,14 +15,15 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { Message, setState, state } from "./store";
-import { Entry, EntryUserData, FeedUserData, toEntryId } from "./feed";
+import { Entry, EntryUserData, Feed, FeedUserData, toEntryId } from "./feed";
 import * as immutable from "immutable"
 
 export function notify(level: Message["level"], text: Message["text"]) {
   setState("status", "message", { level, text })
 }
 
-export async function fetchApi(url: string, options?: any) {
+// return null without notifying if response has ignoredStatus
+export async function fetchApi(url: string, options?: any, ignoredStatus?: number) {
   try {
     const resp = await fetch(`/api/${url}`, {
       headers: {
@@ -30,6 +31,9 @@ export async function fetchApi(url: string, options?: any) {
       },
       ...options
     });
+    if (resp.status === ignoredStatus) {
+      return null;
+    }
     if (!resp.ok) {
       notify("error", `${resp.status} ${resp.statusText} ${await resp.text()}`);
       return undefined;
@@ -72,6 +76,12 @@ export async function checkUpdate() {
     return false
   }
 
+  const ok = await applyStatus(status)
+  updating = false
+  return ok
+}
+
+async function applyStatus(status: ServerStatus) {
   let ok = true
   if (lastUpdated !== status.updated) {
     ok = await getData()
@@ -81,11 +91,51 @@ export async function checkUpdate() {
   }
 
   setState("status", "loading", status.loading)
-  updating = false
   return ok
 }
 
+let eventSource: EventSource | undefined
+// handle status events in order
+let statusEvents = Promise.resolve()
+// resolved when server finishes loading
+let loadingWaiters: Array<(ok: boolean) => void> = []
+
+export function eventsConnected() {
+  return eventSource?.readyState === EventSource.OPEN
+}
+
+// Subscribe to server events to get updates without polling
+export function subscribeEvents() {
+  const source = new EventSource("/api/events")
+  source.addEventListener("status", e => {
+    const status: ServerStatus = JSON.parse(e.data)
+    statusEvents = statusEvents.then(async () => {
+      const ok = await applyStatus(status)
+      if (!status.loading) {
+        loadingWaiters.forEach(resolve => resolve(ok))
+        loadingWaiters = []
+      }
+    })
+  })
+  eventSource = source
+  return () => {
+    source.close()
+    eventSource = undefined
+  }
+}
+
 async function waitForFetching() {
+  if (eventsConnected()) {
+    // register waiter before checking status to avoid missing the event
+    const done = new Promise<boolean>(resolve => loadingWaiters.push(resolve))
+    const ok = await checkUpdate()
+    if (!ok || !state.status.loading) {
+      return ok
+    }
+    return await done
+  }
+
+  // fall back to polling
   const maxBackoff = 10000
   let backoff = 500
   while (true) {
@@ -112,40 +162,88 @@ async function queryEntries(query: {
   });
 }
 
-async function getData() {
-  const [feeds, entries] = await Promise.all([
-    fetchApi("feeds"),
-    // Only get entries without content for efficiency
-    queryEntries({
-      columns: [
-        "feed_url",
-        "id",
-        "link",
-        "author",
-        "title",
-        "categories",
-        "enclosures",
-        "published_at",
-        "updated_at",
-        "server_data",
-        "user_data",
-      ]
-    })
-  ]);
-  if (feeds === undefined || entries == undefined) {
-    return false;
+// Only get entries without content for efficiency
+const ENTRY_COLUMNS = [
+  "feed_url",
+  "id",
+  "link",
+  "author",
+  "title",
+  "categories",
+  "enclosures",
+  "published_at",
+  "updated_at",
+  "server_data",
+  "user_data",
+]
+
+type Changes = {
+  seq: number,
+  feeds: Feed[],
+  entries: Entry[],
+  deleted_feeds: string[],
+  deleted_entries: Array<{ feed_url: string, id: string }>,
+}
+
+// seq of the latest change in local data (null if not loaded yet)
+let lastSeq: number | null = null
+
+// get feeds and entries changed after seq (null if deleted ones have been pruned)
+async function getChanges(since: number): Promise<Changes | null | undefined> {
+  const params = new URLSearchParams({ since: since.toString() })
+  ENTRY_COLUMNS.forEach(c => params.append("columns", c))
+  return await fetchApi(`changes?${params}`, undefined, 410)
+}
+
+function applyChanges(changes: Changes) {
+  const feeds = new Map(state.data.feeds.map(f => [f.url, f] as [string, Feed]))
+  changes.deleted_feeds.forEach(url => feeds.delete(url))
+  changes.feeds.forEach(f => feeds.set(f.url, f))
+
+  const entries = new Map(state.data.entries.map(e => [toEntryId(e), e] as [string, Entry]))
+  changes.deleted_entries.forEach(e => entries.delete(toEntryId(e)))
+  changes.entries.forEach(e => entries.set(toEntryId(e), e))
+
+  setState("data", {
+    feeds: [...feeds.values()],
+    entries: [...entries.values()],
+    // cached contents might be outdated
+    entryContents: state.data.entryContents.deleteAll(
+      [...changes.deleted_entries, ...changes.entries].map(toEntryId)
+    ),
+  })
+}
+
+// sync local data incrementally (or load all data if full is true)
+async function getData(full = false) {
+  if (!full && lastSeq !== null) {
+    const changes = await getChanges(lastSeq)
+    if (changes === undefined) {
+      return false;
+    }
+    if (changes !== null) {
+      applyChanges(changes)
+      lastSeq = changes.seq
+      return true;
+    }
+    // fall back to loading all data
   }
 
+  const changes = await getChanges(0)
+  if (!changes) {
+    return false;
+  }
   setState("data", {
-    feeds,
-    entries,
+    feeds: changes.feeds,
+    entries: changes.entries,
     entryContents: immutable.Map(),
   })
+  lastSeq = changes.seq
   return true;
 }
 
 export async function loadData() {
-  const ok = await getData();
+  const ok = await getData(true);
   if (ok) {
     notify("success", "Loaded feeds successfully")
   }
@@ -30,6 +30,8 @@ export type FeedUserData = {
   archive_blacklist?: string,
   archive_sequential?: boolean,
   archive_interval?: number,
+  // in bytes
+  max_resource_size?: number,
   tags?: string[],
   frozen?: boolean,
 };
@@ -90,7 +92,7 @@ export function toFeedId(feed: Feed) {
   return Base64.encode(feed.url, true);
 }
 
-export function toEntryId(entry: Entry) {
+export function toEntryId(entry: Pick<Entry, "feed_url" | "id">) {
   return Base64.encode(JSON.stringify([entry.feed_url, entry.id]), true);
 }
 